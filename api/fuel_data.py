@@ -1,12 +1,20 @@
 import csv
+import math
+import sys
+import threading
+import weakref
 from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Dict, Iterable, List, Optional, Tuple
 
+import numpy as np
 from django.conf import settings
 
+from .spatial_index import GridIndex
+from .station_cache import StationCache
 
-@dataclass
+
+@dataclass(slots=True)
 class FuelStation:
     opis_id: str
     name: str
@@ -15,11 +23,51 @@ class FuelStation:
     state: str
     rack_id: str
     retail_price: float
-    coordinates: Optional[Tuple[float, float]] = None  # (lat, lon)
-    cache_key: str = field(init=False)
+    # This station's (lat, lon) row of its FuelCatalog's coordinate array, bound when
+    # the catalog is built; the catalog's array is the only copy of the coordinates.
+    _coords: Optional[np.ndarray] = field(default=None, init=False, repr=False, compare=False)
+
+    @property
+    def cache_key(self) -> str:
+        # Built on demand; FuelCatalog.keys holds the keys of catalog stations.
+        return f"{self.opis_id}-{self.address}-{self.city}-{self.state}"
+
+    @property
+    def coordinates(self) -> Optional[Tuple[float, float]]:
+        """(lat, lon) once located through FuelCatalog.record_coords, else None."""
+        if self._coords is None:
+            return None
+        lat, lon = self._coords.tolist()
+        return None if math.isnan(lat) else (lat, lon)
+
 
-    def __post_init__(self):
-        self.cache_key = f"{self.opis_id}-{self.address}-{self.city}-{self.state}"
+FUEL_DATA_COLUMNS = (
+    "OPIS Truckstop ID",
+    "Truckstop Name",
+    "Address",
+    "City",
+    "State",
+    "Rack ID",
+    "Retail Price",
+)
+
+
+def _parse_prices(values: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Parse price strings in one NumPy conversion; returns (prices, valid_mask).
+    Only a feed with malformed prices pays for the per-value fallback.
+    """
+    try:
+        return np.array(values, dtype=np.float64), np.ones(len(values), dtype=bool)
+    except ValueError:
+        prices = np.zeros(len(values))
+        valid = np.ones(len(values), dtype=bool)
+        for idx, value in enumerate(values):
+            try:
+                prices[idx] = float(value)
+            except ValueError:
+                valid[idx] = False
+        return prices, valid
 
 
 def load_fuel_stations(path: Optional[str] = None) -> List[FuelStation]:
@@ -27,45 +75,168 @@ def load_fuel_stations(path: Optional[str] = None) -> List[FuelStation]:
     if not csv_path.exists():
         raise FileNotFoundError(f"Fuel data file not found at {csv_path}")
 
-    stations_by_key: Dict[str, FuelStation] = {}
+    # Dedupe on raw rows first (keyed like FuelStation.cache_key) and only build
+    # FuelStation objects for the surviving rows.
+    cheapest_rows: Dict[str, Tuple[float, List[str]]] = {}
     with open(csv_path, newline="") as fp:
-        reader = csv.DictReader(fp)
-        for row in reader:
-            try:
-                price = float(row["Retail Price"])
-            except (TypeError, ValueError):
-                continue
-            station = FuelStation(
-                opis_id=row["OPIS Truckstop ID"].strip(),
-                name=row["Truckstop Name"].strip(),
-                address=row["Address"].strip(),
-                city=row["City"].strip(),
-                state=row["State"].strip(),
-                rack_id=row["Rack ID"].strip(),
-                retail_price=price,
-            )
-            key = station.cache_key
-            existing = stations_by_key.get(key)
-            if existing is None or price < existing.retail_price:
-                stations_by_key[key] = station
-    return list(stations_by_key.values())
+        reader = csv.reader(fp)
+        header = next(reader, [])
+        try:
+            columns = [header.index(name) for name in FUEL_DATA_COLUMNS]
+        except ValueError as exc:
+            raise ValueError(f"Fuel data file {csv_path} is missing a column: {exc}") from exc
+        opis_col, name_col, address_col, city_col, state_col, rack_col, price_col = columns
+        rows = [row for row in reader if len(row) > max(columns)]
+
+    prices, valid = _parse_prices([row[price_col] for row in rows])
+    for row, price, ok in zip(rows, prices.tolist(), valid.tolist()):
+        if not ok:
+            continue
+        key = (
+            f"{row[opis_col].strip()}-{row[address_col].strip()}-"
+            f"{row[city_col].strip()}-{row[state_col].strip()}"
+        )
+        existing = cheapest_rows.get(key)
+        if existing is None or price < existing[0]:
+            cheapest_rows[key] = (price, row)
+
+    return [
+        FuelStation(
+            opis_id=row[opis_col].strip(),
+            name=row[name_col].strip(),
+            address=row[address_col].strip(),
+            city=row[city_col].strip(),
+            state=row[state_col].strip(),
+            rack_id=row[rack_col].strip(),
+            retail_price=price,
+        )
+        for price, row in cheapest_rows.values()
+    ]
 
 
 def stations_sorted_by_price(stations: Iterable[FuelStation]) -> List[FuelStation]:
     return sorted(stations, key=lambda s: s.retail_price)
 
 
+def city_state_key(city: str, state: str) -> str:
+    # Interned, like the index keys, so dict lookups can match on identity.
+    return sys.intern(f"{city.lower().strip()}|{state.lower().strip()}")
+
+
+def state_key(state: str) -> str:
+    return sys.intern(state.lower().strip())
+
+
 def index_by_city_state(stations: Iterable[FuelStation]) -> Dict[str, List[FuelStation]]:
     index: Dict[str, List[FuelStation]] = {}
     for station in stations:
-        key = f"{station.city.lower().strip()}|{station.state.lower().strip()}"
-        index.setdefault(key, []).append(station)
+        index.setdefault(city_state_key(station.city, station.state), []).append(station)
     return index
 
 
 def index_by_state(stations: Iterable[FuelStation]) -> Dict[str, List[FuelStation]]:
     index: Dict[str, List[FuelStation]] = {}
     for station in stations:
-        key = station.state.lower().strip()
-        index.setdefault(key, []).append(station)
+        index.setdefault(state_key(station.state), []).append(station)
     return index
+
+
+class FuelCatalog:
+    """
+    Stations plus their city/state and state indexes, and everything located so far.
+
+    `coords` is the canonical (N, 2) float64 [lat, lon] array (NaN = not located yet):
+    `lats`/`lons` are views of its columns and each FuelStation.coordinates reads its
+    own row. Together with `prices` and `grid` it is aligned with `stations` and shared
+    by every request's StationLocator. record_coords is the one place coordinates are
+    written, so a station located by any request is in every locator's view straight
+    away. A station belongs to one catalog: building another rebinds its row.
+    """
+
+    def __init__(self, stations: List[FuelStation]):
+        self.stations = stations
+        self.city_state_index = index_by_city_state(stations)
+        self.state_index = index_by_state(stations)
+        self.prices = np.fromiter((s.retail_price for s in stations), dtype=np.float64, count=len(stations))
+        # Cache keys formatted once per process, aligned with `stations`, plus the
+        # lookups from a key or a station object back to its position.
+        self.keys = np.array([station.cache_key for station in stations], dtype=object)
+        self.positions: Dict[str, int] = {key: idx for idx, key in enumerate(self.keys.tolist())}
+        self.positions_by_id: Dict[int, int] = {id(station): idx for idx, station in enumerate(stations)}
+        self.by_price = np.argsort(self.prices, kind="stable")
+        self.price_rank = np.empty(len(stations), dtype=np.int32)
+        self.price_rank[self.by_price] = np.arange(len(stations), dtype=np.int32)
+        self.sorted_by_price = [stations[idx] for idx in self.by_price]
+        # Cheapest-first positions of the index pools, keyed by the pool list's identity
+        # and filled in the first time each pool is asked for.
+        self.index_pool_ids = {
+            id(pool) for index in (self.city_state_index, self.state_index) for pool in index.values()
+        }
+        self.index_pool_ids.add(id(self.sorted_by_price))
+        self._pool_positions: Dict[int, np.ndarray] = {id(self.sorted_by_price): self.by_price}
+        self.coords = np.full((len(stations), 2), np.nan)
+        for idx, station in enumerate(stations):
+            if station._coords is not None:
+                self.coords[idx] = station._coords
+            station._coords = self.coords[idx]
+        self.lats = self.coords[:, 0]
+        self.lons = self.coords[:, 1]
+        self.grid = GridIndex()
+        for idx in np.flatnonzero(~np.isnan(self.lats)):
+            self.grid.add(idx, self.lats[idx], self.lons[idx])
+        self._lock = threading.Lock()
+        self._applied_caches: "weakref.WeakSet[StationCache]" = weakref.WeakSet()
+
+    def record_coords(self, idx: int, coords: Tuple[float, float]) -> None:
+        """Locate the station at position `idx`; the first coordinates recorded win."""
+        with self._lock:
+            if not np.isnan(self.lats[idx]):
+                return
+            # One row write, before the grid add, so every grid hit has coordinates.
+            self.coords[idx] = coords
+            self.grid.add(idx, coords[0], coords[1])
+
+    def position(self, station: FuelStation) -> int:
+        idx = self.positions_by_id.get(id(station))
+        return idx if idx is not None else self.positions[station.cache_key]
+
+    def pool_positions(self, pool: List[FuelStation]) -> np.ndarray:
+        """Positions of `pool`'s stations, cheapest first; memoized for index pools."""
+        positions = self._pool_positions.get(id(pool))
+        if positions is None:
+            positions = np.fromiter(map(self.position, pool), dtype=np.intp, count=len(pool))
+            positions = positions[np.argsort(self.price_rank[positions], kind="stable")]
+            if id(pool) in self.index_pool_ids:
+                self._pool_positions[id(pool)] = positions
+        return positions
+
+    def apply_cached_coords(self, cache: StationCache) -> None:
+        """Record `cache`'s persisted coordinates for unlocated stations, once per cache."""
+        if cache in self._applied_caches:
+            return
+        self._applied_caches.add(cache)
+        unlocated = np.flatnonzero(np.isnan(self.lats))
+        for key, coords in cache.get_many(self.keys[unlocated].tolist()).items():
+            self.record_coords(self.positions[key], coords)
+
+
+def load_fuel_catalog(path: Optional[str] = None) -> FuelCatalog:
+    return FuelCatalog(load_fuel_stations(path))
+
+
+_catalog: Optional[FuelCatalog] = None
+_catalog_lock = threading.Lock()
+
+
+def get_fuel_catalog() -> FuelCatalog:
+    """
+    Process-wide catalog, parsed and indexed once. Requests share it, so coordinates
+    geocoded by one request are known to the next. The lock keeps concurrent first
+    requests from building (and geocoding into) catalogs that are then dropped.
+    """
+    global _catalog
+    if _catalog is None:
+        with _catalog_lock:
+            if _catalog is None:
+                _catalog = load_fuel_catalog()
+    return _catalog
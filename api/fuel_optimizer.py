@@ -1,13 +1,21 @@
+import logging
 from dataclasses import dataclass
+from functools import cached_property
 from typing import Dict, List, Optional, Tuple
 
-from .geometry import accumulate_distances_miles, interpolate_point, nearest_point_distance_miles, downsample_polyline
+from .geometry import accumulate_distances_miles, interpolate_points, nearest_point_distance_miles, downsample_polyline
+from .geometry import PolylineSegments, polyline_segments
 from .geometry import haversine_miles
 from .fuel_data import FuelStation
 from .station_locator import StationLocator
 from .mapbox_client import MapboxClient
 import math
 
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
 
 @dataclass
 class FuelStop:
@@ -19,13 +27,16 @@ class FuelStop:
 
 
 def build_mile_markers(distance_miles: float, range_miles: float) -> List[float]:
-    markers = [0.0]
     if distance_miles <= 0:
-        return markers
-    mile = range_miles
-    while mile < distance_miles:
-        markers.append(round(mile, 2))
-        mile += range_miles
+        return [0.0]
+    if range_miles <= 0:
+        raise ValueError("range_miles must be positive.")
+    if range_miles >= distance_miles:
+        return [0.0, round(distance_miles, 2)]
+    # Multiples of the range strictly before the destination, computed in one shot
+    # rather than by repeated float addition.
+    steps = np.arange(math.ceil(distance_miles / range_miles) + 1, dtype=np.float64) * range_miles
+    markers = np.round(steps[steps < distance_miles], 2).tolist()
     markers.append(round(distance_miles, 2))
     return markers
 
@@ -50,45 +61,60 @@ class FuelPlanner:
         self.search_radius_miles = search_radius_miles
         self.geocode_budget_per_stop = geocode_budget_per_stop
         self._coordinates = route_geometry["coordinates"]
-        self._cumulative = accumulate_distances_miles(self._coordinates)
-        self._fallback_polyline = downsample_polyline(self._coordinates, max_points=400)
+        # [lon, lat] rows, shared by the vectorized geometry helpers.
+        self._coords_np = np.asarray(self._coordinates, dtype=np.float64)
+        self._cumulative = accumulate_distances_miles(self._coords_np)
+        self._cumulative_np = np.asarray(self._cumulative)
         self.total_distance_miles = (
             explicit_distance_miles if explicit_distance_miles is not None else self._cumulative[-1]
         )
 
-    def _coordinate_at(self, mile_marker: float) -> Tuple[float, float]:
-        return interpolate_point(self._coordinates, self._cumulative, mile_marker)
+    @cached_property
+    def _fallback_segments(self) -> PolylineSegments:
+        # Simplifying the route costs tens of ms on long geometries and only the
+        # last-resort nearest_on_route search needs it, so it is built on first use.
+        return polyline_segments(downsample_polyline(self._coords_np, max_points=400))
+
+    def _coordinates_at(self, mile_markers: List[float]) -> List[Tuple[float, float]]:
+        points = interpolate_points(self._coords_np, self._cumulative_np, mile_markers)
+        return [(float(lat), float(lon)) for lat, lon in points]
 
     def plan_stops(self) -> List[FuelStop]:
-        markers = build_mile_markers(self.total_distance_miles, self.vehicle_range_miles)
-        stops: List[FuelStop] = []
         # We fuel at every marker except the destination.
-        for mile_marker in markers[:-1]:
-            coord = self._coordinate_at(mile_marker)
+        markers = build_mile_markers(self.total_distance_miles, self.vehicle_range_miles)[:-1]
+        marker_coords = self._coordinates_at(markers)
+        lookups = self.mapbox.reverse_geocode_many(marker_coords, return_exceptions=True)
+        candidate_pools = []
+        for mile_marker, city_state in zip(markers, lookups):
             candidates = []
-            try:
-                city_state = self.mapbox.reverse_geocode(coord[0], coord[1])
-                print(f"[marker {mile_marker:.2f}] reverse geocode -> {city_state}", flush=True)
-            except Exception as exc:
+            if isinstance(city_state, Exception):
+                logger.debug("[marker %.2f] reverse geocode failed: %s", mile_marker, city_state)
                 city_state = None
-                print(f"[marker {mile_marker:.2f}] reverse geocode failed: {exc}", flush=True)
+            else:
+                logger.debug("[marker %.2f] reverse geocode -> %s", mile_marker, city_state)
             if city_state:
                 candidates = self.locator.stations_for_city_state(
                     city_state.get("city"), city_state.get("state")
                 )
-                print(f"[marker {mile_marker:.2f}] city/state candidates: {len(candidates)}", flush=True)
+                logger.debug("[marker %.2f] city/state candidates: %d", mile_marker, len(candidates))
                 if not candidates:
                     candidates = self.locator.stations_for_state(city_state.get("state"))
                     if candidates:
-                        print(f"[marker {mile_marker:.2f}] falling back to state-only stations", flush=True)
-                    print(f"[marker {mile_marker:.2f}] state candidates: {len(candidates)}", flush=True)
+                        logger.debug("[marker %.2f] falling back to state-only stations", mile_marker)
+                    logger.debug("[marker %.2f] state candidates: %d", mile_marker, len(candidates))
+            candidate_pools.append(candidates)
 
+        # Cheapest already-located station per marker, for all markers in one pass.
+        known_best = self.locator.cheapest_for_markers(marker_coords, self.search_radius_miles, candidate_pools)
+        stops: List[FuelStop] = []
+        for mile_marker, coord, candidates, best in zip(markers, marker_coords, candidate_pools, known_best):
             station = self.locator.cheapest_nearby(
                 coord,
                 radius_miles=self.search_radius_miles,
                 allow_geocode=True,
                 geocode_budget=self.geocode_budget_per_stop,
                 candidates=candidates,
+                known_best=int(best),
             )
             note = None
             if station is None and candidates:
@@ -110,15 +136,17 @@ class FuelPlanner:
                 station = self.locator.nearest_to_point(coord)
                 note = "Fallback to nearest station to marker; no nearby city/state match with coords."
             if station is None:
-                station = self.locator.nearest_on_route(self._fallback_polyline)
+                station = self.locator.nearest_on_route_prepared(self._fallback_segments)
                 note = note or "Fallback to nearest station along route; no nearby coordinates available."
-            if station and station.coordinates:
-                dist = haversine_miles(station.coordinates, coord)
-                print(
-                    f"[marker {mile_marker:.2f}] stop -> {station.name} ({station.city}, {station.state}) "
-                    f"price {station.retail_price} dist_to_marker_mi ~{dist:.1f}"
-                    ,
-                    flush=True,
+            if station and station.coordinates and logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "[marker %.2f] stop -> %s (%s, %s) price %s dist_to_marker_mi ~%.1f",
+                    mile_marker,
+                    station.name,
+                    station.city,
+                    station.state,
+                    station.retail_price,
+                    haversine_miles(station.coordinates, coord),
                 )
             price = station.retail_price if station else None
             stops.append(
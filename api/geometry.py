@@ -1,5 +1,14 @@
+import heapq
 import math
-from typing import List, Sequence, Tuple
+from typing import List, NamedTuple, Sequence, Tuple, Union
+
+import numpy as np
+
+from . import geometry_numba
+
+EARTH_RADIUS_MILES = 3958.8
+# Deviations below this (about 0.1 mm) are float noise, not bends, in downsample_polyline.
+COLLINEAR_TOLERANCE_DEGREES = 1e-9
 
 
 def haversine_miles(point_a: Tuple[float, float], point_b: Tuple[float, float]) -> float:
@@ -13,18 +22,38 @@ def haversine_miles(point_a: Tuple[float, float], point_b: Tuple[float, float])
         d_lambda / 2
     ) ** 2
     c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    miles = 3958.8 * c
+    miles = EARTH_RADIUS_MILES * c
     return miles
 
 
+def haversine_miles_array(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """Vectorized great-circle distance in miles; arguments broadcast like NumPy arrays."""
+    phi1 = np.radians(lat1)
+    phi2 = np.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = np.radians(np.subtract(lon2, lon1))
+    a = np.sin(d_phi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(d_lambda / 2) ** 2
+    return EARTH_RADIUS_MILES * 2 * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def distances_to_point_miles(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """Haversine miles from (lat, lon) to each point of the `lats`/`lons` arrays."""
+    if geometry_numba.NUMBA_AVAILABLE:
+        return geometry_numba.haversine_all(
+            np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64), float(lat), float(lon)
+        )
+    return haversine_miles_array(lat, lon, lats, lons)
+
+
 def accumulate_distances_miles(points: Sequence[Sequence[float]]) -> List[float]:
-    """Return cumulative miles along the polyline."""
-    distances = [0.0]
-    for idx in range(1, len(points)):
-        prev = (points[idx - 1][1], points[idx - 1][0])
-        current = (points[idx][1], points[idx][0])
-        distances.append(distances[-1] + haversine_miles(prev, current))
-    return distances
+    """Return cumulative miles along the polyline of [lon, lat] points."""
+    arr = np.asarray(points, dtype=np.float64)
+    if len(arr) < 2:
+        return [0.0]
+    if geometry_numba.NUMBA_AVAILABLE:
+        return geometry_numba.accumulate_miles(arr).tolist()
+    segments = haversine_miles_array(arr[:-1, 1], arr[:-1, 0], arr[1:, 1], arr[1:, 0])
+    return np.concatenate(([0.0], np.cumsum(segments))).tolist()
 
 
 def interpolate_point(
@@ -34,68 +63,160 @@ def interpolate_point(
 ) -> Tuple[float, float]:
     """
     Return the (lat, lon) point along the polyline at the requested distance.
+    Pass `cumulative` as an ndarray to avoid a conversion on every call.
     """
-    if target_miles <= 0:
-        return points[0][1], points[0][0]
-    if target_miles >= cumulative[-1]:
-        return points[-1][1], points[-1][0]
-    for idx in range(1, len(cumulative)):
-        if cumulative[idx] >= target_miles:
-            prev_mile = cumulative[idx - 1]
-            seg_length = cumulative[idx] - prev_mile
-            ratio = (target_miles - prev_mile) / seg_length if seg_length else 0
-            lon = points[idx - 1][0] + (points[idx][0] - points[idx - 1][0]) * ratio
-            lat = points[idx - 1][1] + (points[idx][1] - points[idx - 1][1]) * ratio
-            return (lat, lon)
-    return points[-1][1], points[-1][0]
+    lat, lon = interpolate_points(points, cumulative, [target_miles])[0]
+    return (float(lat), float(lon))
+
+
+def interpolate_points(
+    points: Sequence[Sequence[float]],
+    cumulative: Sequence[float],
+    targets_miles: Sequence[float],
+) -> np.ndarray:
+    """Vectorized interpolate_point: return an (M, 2) array of (lat, lon) rows, one per target."""
+    arr = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    cum = np.asarray(cumulative, dtype=np.float64)
+    targets = np.asarray(targets_miles, dtype=np.float64).reshape(-1)
+    if len(arr) < 2:
+        return np.repeat(arr[:1, ::-1], len(targets), axis=0)
+    idx = np.clip(np.searchsorted(cum, targets, side="left"), 1, len(cum) - 1)
+    prev_mile = cum[idx - 1]
+    seg_length = cum[idx] - prev_mile
+    ratio = np.divide(
+        targets - prev_mile, seg_length, out=np.zeros_like(targets), where=seg_length > 0
+    )
+    lonlat = arr[idx - 1] + (arr[idx] - arr[idx - 1]) * ratio[:, None]
+    lonlat[targets <= 0] = arr[0]
+    lonlat[targets >= cum[-1]] = arr[-1]
+    return lonlat[:, ::-1]
+
+
+class PolylineSegments(NamedTuple):
+    """Per-segment arrays of a [lon, lat] polyline, computed once and reused per query."""
+
+    points: np.ndarray
+    lon1: np.ndarray
+    lat1: np.ndarray
+    dx: np.ndarray
+    dy: np.ndarray
+    denom: np.ndarray  # squared segment length; 1.0 for zero-length segments
+
+
+def polyline_segments(points: Sequence[Sequence[float]]) -> PolylineSegments:
+    arr = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    start, end = arr[:-1], arr[1:]
+    dx = end[:, 0] - start[:, 0]
+    dy = end[:, 1] - start[:, 1]
+    denom = dx * dx + dy * dy
+    return PolylineSegments(
+        points=arr,
+        lon1=start[:, 0],
+        lat1=start[:, 1],
+        dx=dx,
+        dy=dy,
+        denom=np.where(denom > 0, denom, 1.0),
+    )
 
 
 def nearest_point_distance_miles(
-    target: Tuple[float, float], points: Sequence[Sequence[float]]
-) -> float:
-    """Return the closest distance in miles from the target point to a polyline."""
-    closest = float("inf")
-    for idx in range(1, len(points)):
-        segment_start = (points[idx - 1][1], points[idx - 1][0])
-        segment_end = (points[idx][1], points[idx][0])
-        distance = _point_to_segment_distance_miles(target, segment_start, segment_end)
-        closest = min(closest, distance)
-    return closest
-
-
-def _point_to_segment_distance_miles(
-    point: Tuple[float, float],
-    start: Tuple[float, float],
-    end: Tuple[float, float],
+    target: Tuple[float, float],
+    points: Union[Sequence[Sequence[float]], PolylineSegments],
 ) -> float:
     """
-    Approximate the shortest distance from a point to a line segment on Earth.
-    Uses naive projection in Cartesian space, good enough for short distances.
+    Return the closest distance in miles from the target point to a polyline.
+    Pass a PolylineSegments to skip re-deriving the segment arrays on every call.
+    """
+    segments = points if isinstance(points, PolylineSegments) else polyline_segments(points)
+    if len(segments.dx) == 0:
+        return float("inf")
+    lat, lon = target
+    if geometry_numba.NUMBA_AVAILABLE:
+        return float(geometry_numba.nearest_segment_miles(lat, lon, segments.points))
+    return float(nearest_point_distances_miles([lat], [lon], segments)[0])
+
+
+def nearest_point_distances_miles(
+    lats: np.ndarray, lons: np.ndarray, segments: PolylineSegments, chunk_size: int = 512
+) -> np.ndarray:
+    """
+    Vectorized nearest_point_distance_miles for many points at once: returns the
+    closest distance from each (lat, lon) to the polyline, inf if it has no segments.
+    Points are processed in chunks to bound the (points x segments) temporaries.
+
+    Each point is projected onto every segment in naive lon/lat space, the segments are
+    ranked with an equirectangular approximation (no trig per segment), and only the
+    winning projection is measured with haversine.
     """
-    lat, lon = point
-    lat1, lon1 = start
-    lat2, lon2 = end
-    # Convert to Cartesian for the projection
-    x0, y0 = lon, lat
-    x1, y1 = lon1, lat1
-    x2, y2 = lon2, lat2
-
-    dx, dy = x2 - x1, y2 - y1
-    if dx == dy == 0:
-        return haversine_miles(point, start)
-    t = ((x0 - x1) * dx + (y0 - y1) * dy) / (dx * dx + dy * dy)
-    t_clamped = max(0, min(1, t))
-    proj = (x1 + t_clamped * dx, y1 + t_clamped * dy)
-    return haversine_miles(point, (proj[1], proj[0]))
-
-
-def downsample_polyline(points: Sequence[Sequence[float]], max_points: int = 400) -> List[List[float]]:
-    """Reduce number of polyline points to cap CPU work; preserves endpoints."""
-    pts = list(points)
-    if len(pts) <= max_points:
-        return pts
-    step = max(1, len(pts) // max_points)
-    reduced = pts[::step]
-    if reduced[-1] != pts[-1]:
-        reduced.append(pts[-1])
-    return reduced
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    out = np.full(len(lats), np.inf)
+    if not len(segments.dx):
+        return out
+    if geometry_numba.NUMBA_AVAILABLE:
+        return geometry_numba.nearest_on_poly_all(lats, lons, segments.points)
+    for start in range(0, len(lats), chunk_size):
+        lat = lats[start:start + chunk_size, None]
+        lon = lons[start:start + chunk_size, None]
+        t = (lon - segments.lon1) * segments.dx + (lat - segments.lat1) * segments.dy
+        t = np.clip(t / segments.denom, 0, 1)
+        proj_lat = segments.lat1 + t * segments.dy
+        proj_lon = segments.lon1 + t * segments.dx
+        cos_lat = np.cos(np.radians(lat))
+        approx = np.hypot(proj_lat - lat, (proj_lon - lon) * cos_lat)
+        best = np.argmin(approx, axis=1)
+        rows = np.arange(len(best))
+        out[start:start + chunk_size] = haversine_miles_array(
+            lat[:, 0], lon[:, 0], proj_lat[rows, best], proj_lon[rows, best]
+        )
+    return out
+
+
+def downsample_polyline(points: Sequence[Sequence[float]], max_points: int = 400) -> np.ndarray:
+    """
+    Reduce number of polyline points to cap CPU work; preserves endpoints.
+    Returns an (N, 2) float64 array; an array already within budget is returned as is.
+
+    Greedy top-down Douglas-Peucker: starting from the endpoints, repeatedly keep the
+    vertex that deviates most from the current simplified line until max_points are
+    kept, so the point budget goes where the route actually bends.
+    """
+    arr = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if len(arr) <= max_points:
+        return arr
+    # Scale longitude so perpendicular distances are roughly isotropic.
+    xy = arr * np.array([math.cos(math.radians(float(arr[:, 1].mean()))), 1.0])
+    keep = [0, len(arr) - 1]
+    heap: List[Tuple[float, int, int, int]] = []
+
+    def push(first: int, last: int) -> None:
+        if last - first < 2:
+            return
+        offset, deviation = _farthest_from_chord(xy, first, last)
+        heapq.heappush(heap, (-deviation, first, last, first + 1 + offset))
+
+    push(0, len(arr) - 1)
+    while heap and len(keep) < max_points:
+        neg_deviation, first, last, split = heapq.heappop(heap)
+        if -neg_deviation <= COLLINEAR_TOLERANCE_DEGREES:
+            break  # everything left is collinear with the kept points
+        keep.append(split)
+        push(first, split)
+        push(split, last)
+    keep.sort()
+    return arr[keep]
+
+
+def _farthest_from_chord(xy: np.ndarray, first: int, last: int) -> Tuple[int, float]:
+    """Return (offset into xy[first + 1:last], distance) of the vertex farthest from the chord."""
+    start, end = xy[first], xy[last]
+    interior = xy[first + 1:last]
+    chord = end - start
+    length_sq = float(chord @ chord)
+    if length_sq == 0:
+        t = np.zeros(len(interior))
+    else:
+        t = np.clip((interior - start) @ chord / length_sq, 0, 1)
+    deviation = np.hypot(*(interior - (start + t[:, None] * chord)).T)
+    offset = int(np.argmax(deviation))
+    return offset, float(deviation[offset])
@@ -0,0 +1,104 @@
+"""
+Optional Numba-compiled kernels for the polyline hot loops in `geometry`.
+
+Numba is not a hard requirement: when it is missing, NUMBA_AVAILABLE is False and
+`geometry` keeps using its NumPy/pure-Python implementations.
+
+The kernels are deliberately serial: they run inside request handlers on several
+threads at once, and Numba's fallback `workqueue` threading layer aborts the process
+on concurrent parallel calls. The inputs (grid hits, a few hundred segments) are small
+enough that parallelism bought little anyway.
+"""
+import math
+
+import numpy as np
+
+try:
+    from numba import njit
+
+    NUMBA_AVAILABLE = True
+except ImportError:  # pragma: no cover - depends on the environment
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
+
+
+EARTH_RADIUS_MILES = 3958.8
+
+
+@njit(cache=True, fastmath=True)
+def haversine_miles(lat1, lon1, lat2, lon2):
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    d_phi = math.radians(lat2 - lat1)
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return EARTH_RADIUS_MILES * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+@njit(cache=True, fastmath=True)
+def accumulate_miles(points):
+    """Cumulative miles along an (N, 2) float64 array of [lon, lat] rows."""
+    n = points.shape[0]
+    out = np.zeros(max(n, 1))
+    for idx in range(1, n):
+        out[idx] = out[idx - 1] + haversine_miles(
+            points[idx - 1, 1], points[idx - 1, 0], points[idx, 1], points[idx, 0]
+        )
+    return out
+
+
+@njit(cache=True, fastmath=True)
+def haversine_all(lats, lons, lat, lon):
+    """Miles from (lat, lon) to every point of the `lats`/`lons` arrays."""
+    out = np.empty(lats.shape[0])
+    for idx in range(lats.shape[0]):
+        out[idx] = haversine_miles(lat, lon, lats[idx], lons[idx])
+    return out
+
+
+@njit(cache=True, fastmath=True)
+def _project(lat, lon, cos_lat, points, idx):
+    """Projection of (lat, lon) onto segment `idx` and its equirectangular distance."""
+    lon1 = points[idx, 0]
+    lat1 = points[idx, 1]
+    dx = points[idx + 1, 0] - lon1
+    dy = points[idx + 1, 1] - lat1
+    denom = dx * dx + dy * dy
+    t = 0.0
+    if denom > 0:
+        t = min(1.0, max(0.0, ((lon - lon1) * dx + (lat - lat1) * dy) / denom))
+    proj_lat = lat1 + t * dy
+    proj_lon = lon1 + t * dx
+    return math.hypot(proj_lat - lat, (proj_lon - lon) * cos_lat), proj_lat, proj_lon
+
+
+@njit(cache=True, fastmath=True)
+def nearest_segment_miles(lat, lon, points):
+    """
+    Closest distance from (lat, lon) to an (N, 2) [lon, lat] polyline with N >= 2.
+    Segments are ranked with an equirectangular approximation and only the winning
+    projection is measured with haversine. The running best is seeded from segment 0
+    rather than inf, which fastmath lets the compiler assume never occurs.
+    """
+    cos_lat = math.cos(math.radians(lat))
+    best_approx, best_lat, best_lon = _project(lat, lon, cos_lat, points, 0)
+    for idx in range(1, points.shape[0] - 1):
+        approx, proj_lat, proj_lon = _project(lat, lon, cos_lat, points, idx)
+        if approx < best_approx:
+            best_approx = approx
+            best_lat = proj_lat
+            best_lon = proj_lon
+    return haversine_miles(lat, lon, best_lat, best_lon)
+
+
+@njit(cache=True, fastmath=True)
+def nearest_on_poly_all(lats, lons, points):
+    """nearest_segment_miles for every point of `lats`/`lons`; `points` needs N >= 2."""
+    out = np.empty(lats.shape[0])
+    for idx in range(lats.shape[0]):
+        out[idx] = nearest_segment_miles(lats[idx], lons[idx], points)
+    return out
@@ -1,9 +1,23 @@
-import json
-from typing import Dict, Optional, Sequence, Tuple
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple, Union
 from urllib.parse import quote
 
+import numpy as np
+import orjson
 import requests
 from django.conf import settings
+from django.core.cache import caches
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .geometry import downsample_polyline
+from .ttl_cache import TTLCache
+
+
+# Bit offsets of the six 5-bit chunks a zigzagged polyline delta can need.
+_POLYLINE_SHIFTS = np.arange(0, 30, 5, dtype=np.int64)
 
 
 class MapboxClientError(Exception):
@@ -12,55 +26,124 @@ class MapboxClientError(Exception):
 
 class MapboxClient:
     BASE_URL = "https://api.mapbox.com"
-    _geocode_cache = {}
-    _reverse_cache = {}
+    REVERSE_PRECISION = 3  # decimal places, ~110m cells
+    REVERSE_CACHE_TIMEOUT = 7 * 24 * 60 * 60  # city/state for a point does not change
+    BATCH_SIZE = 50  # queries per batch geocoding request (Mapbox maximum)
+    REVERSE_WORKERS = 8  # concurrent reverse geocodes in reverse_geocode_many
+    GEOCODE_WORKERS = 8  # concurrent single-query geocodes when a batch request is refused
+    LOCAL_CACHE_SIZE = 10_000
+    LOCAL_CACHE_TTL = 24 * 60 * 60
+    GEOCODE_CACHE_TIMEOUT = 24 * 60 * 60
+    ROUTE_CACHE_TIMEOUT = 60 * 60  # directions and static-map paths; traffic-free but not forever
+    ROUTE_PRECISION = 4  # decimal places of start/end in the directions cache key, ~11m
+    # Bounded in-process tier; CACHES["mapbox"], when configured, is the shared tier
+    # behind it.
+    _geocode_cache = TTLCache(LOCAL_CACHE_SIZE, LOCAL_CACHE_TTL)
+    _reverse_cache = TTLCache(LOCAL_CACHE_SIZE, LOCAL_CACHE_TTL)
+    _path_cache = TTLCache(512, ROUTE_CACHE_TIMEOUT)  # encoded static-map path overlays
+    # Tokens whose account rejected the batch (mapbox.places-permanent) endpoint.
+    _batch_unsupported = set()
+    # One keep-alive pool per token, shared by every client (views build one per request).
+    _sessions: Dict[str, requests.Session] = {}
+    _sessions_lock = threading.Lock()
 
     def __init__(self, access_token: Optional[str] = None):
         token = access_token or settings.MAPBOX_ACCESS_TOKEN
         if not token:
             raise MapboxClientError("MAPBOX_ACCESS_TOKEN is not configured.")
         self.access_token = token
+        self._session = self._shared_session(token)
+
+    @classmethod
+    def _shared_session(cls, token: str) -> requests.Session:
+        session = cls._sessions.get(token)
+        if session is not None:
+            return session
+        with cls._sessions_lock:
+            session = cls._sessions.get(token)
+            if session is None:
+                session = requests.Session()
+                retry = Retry(
+                    total=3,
+                    backoff_factor=0.2,
+                    status_forcelist=[429, 502, 503, 504],
+                    allowed_methods=["GET"],
+                    # Hand the last response back so callers still see its status code.
+                    raise_on_status=False,
+                )
+                session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retry))
+                cls._sessions[token] = session
+        return session
+
+    @staticmethod
+    def _shared_cache():
+        # Only a dedicated backend: the default LocMemCache would duplicate the in-process
+        # tier, and large route payloads would cull its geocodes.
+        return caches["mapbox"] if "mapbox" in settings.CACHES else None
+
+    def _cached(self, local: TTLCache, prefix: str, key: Hashable):
+        value = local.get(key)
+        shared = self._shared_cache()
+        if value is None and shared is not None:
+            value = shared.get(self._shared_key(prefix, key))
+            if value is not None:
+                local.set(key, value)
+        return value
+
+    def _remember(self, local: TTLCache, prefix: str, key: Hashable, value, timeout: int) -> None:
+        local.set(key, value)
+        shared = self._shared_cache()
+        if shared is not None:
+            shared.set(self._shared_key(prefix, key), value, timeout=timeout)
+
+    @staticmethod
+    def _shared_key(prefix: str, key: Hashable) -> str:
+        # Only built on an in-process miss; hashed so free-text queries are valid keys
+        # for every cache backend.
+        return f"{prefix}:{hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()}"
 
     def _cache_key(self, query: str) -> str:
         return query.strip().lower()
 
-    def _reverse_cache_key(self, lat: float, lon: float) -> str:
-        # round to ~11m precision to increase cache hits
-        return f"{round(lat,4)},{round(lon,4)}"
+    def _reverse_cache_key(self, lat: float, lon: float) -> Tuple[float, float]:
+        # round to ~110m precision so nearby markers share a cache entry
+        return (round(lat, self.REVERSE_PRECISION), round(lon, self.REVERSE_PRECISION))
 
     def geocode(self, query: str) -> Optional[Tuple[float, float]]:
         """Returns (lat, lon) for a query or None if nothing is found."""
         key = self._cache_key(query)
-        if key in self._geocode_cache:
-            return self._geocode_cache[key]
+        cached = self._cached(self._geocode_cache, "geocode", key)
+        if cached is not None:
+            return cached
 
         url = f"{self.BASE_URL}/geocoding/v5/mapbox.places/{quote(query)}.json"
         params = {"access_token": self.access_token, "limit": 1, "country": "US"}
-        response = requests.get(url, params=params, timeout=10)
+        response = self._session.get(url, params=params, timeout=10)
         if response.status_code != 200:
             raise MapboxClientError(f"Geocoding failed: {response.text}")
-        data = response.json()
+        data = orjson.loads(response.content)
         features = data.get("features") or []
         if not features:
             return None
         lon, lat = features[0]["center"]
-        self._geocode_cache[key] = (lat, lon)
+        self._remember(self._geocode_cache, "geocode", key, (lat, lon), self.GEOCODE_CACHE_TIMEOUT)
         return (lat, lon)
 
     def geocode_with_state(self, query: str, state: str, limit: int = 5) -> Optional[Tuple[float, float]]:
         """
         Geocode and ensure the returned feature's region short_code matches the requested state.
         """
-        cache_key = f"{self._cache_key(query)}|{state.strip().lower()}|{limit}"
-        if cache_key in self._geocode_cache:
-            return self._geocode_cache[cache_key]
+        cache_key = self._geocode_cache_key(query, state, limit)
+        cached = self._cached(self._geocode_cache, "geocode", cache_key)
+        if cached is not None:
+            return cached
 
         url = f"{self.BASE_URL}/geocoding/v5/mapbox.places/{quote(query)}.json"
         params = {"access_token": self.access_token, "limit": limit, "country": "US"}
-        resp = requests.get(url, params=params, timeout=10)
+        resp = self._session.get(url, params=params, timeout=10)
         if resp.status_code != 200:
             return None
-        data = resp.json()
+        data = orjson.loads(resp.content)
         features = data.get("features") or []
         state_upper = state.strip().upper()
         for feat in features:
@@ -71,18 +154,110 @@ class MapboxClient:
                     break
             if region and region == state_upper:
                 lon, lat = feat["center"]
-                self._geocode_cache[cache_key] = (lat, lon)
+                self._remember(self._geocode_cache, "geocode", cache_key, (lat, lon), self.GEOCODE_CACHE_TIMEOUT)
                 return (lat, lon)
         return None
 
+    def geocode_batch(
+        self, queries: Sequence[str], states: Optional[Sequence[Optional[str]]] = None, limit: int = 5
+    ) -> List[Optional[Tuple[float, float]]]:
+        """
+        Geocode many queries, BATCH_SIZE per request, returning (lat, lon) or None for each.
+        With `states`, a query only matches a feature in that state (as geocode_with_state).
+        Falls back to concurrent single-query requests for queries a batch leaves unanswered.
+        """
+        states = list(states) if states is not None else [None] * len(queries)
+        results: List[Optional[Tuple[float, float]]] = [None] * len(queries)
+        todo = []
+        for idx, (query, state) in enumerate(zip(queries, states)):
+            cached = self._cached(self._geocode_cache, "geocode", self._geocode_cache_key(query, state, limit))
+            if cached:
+                results[idx] = cached
+            else:
+                todo.append(idx)
+
+        for start in range(0, len(todo), self.BATCH_SIZE):
+            chunk = todo[start:start + self.BATCH_SIZE]
+            collections = []
+            if self.access_token not in self._batch_unsupported:
+                collections = self._batch_request([queries[idx] for idx in chunk], limit) or []
+            for idx, collection in zip(chunk, collections):
+                coords = self._match_feature(collection.get("features") or [], states[idx])
+                if coords:
+                    key = self._geocode_cache_key(queries[idx], states[idx], limit)
+                    self._remember(self._geocode_cache, "geocode", key, coords, self.GEOCODE_CACHE_TIMEOUT)
+                    results[idx] = coords
+            # A refused batch, or a reply with fewer collections than queries, leaves a
+            # tail that is looked up one query at a time.
+            tail = chunk[len(collections):]
+            located = self._geocode_each([(queries[idx], states[idx]) for idx in tail], limit)
+            for idx, coords in zip(tail, located):
+                results[idx] = coords
+        return results
+
+    def _geocode_each(
+        self, lookups: Sequence[Tuple[str, Optional[str]]], limit: int
+    ) -> List[Optional[Tuple[float, float]]]:
+        def lookup(item: Tuple[str, Optional[str]]) -> Optional[Tuple[float, float]]:
+            query, state = item
+            return self.geocode(query) if state is None else self.geocode_with_state(query, state, limit)
+
+        if len(lookups) <= 1:
+            return [lookup(item) for item in lookups]
+        with ThreadPoolExecutor(max_workers=min(self.GEOCODE_WORKERS, len(lookups))) as pool:
+            return list(pool.map(lookup, lookups))
+
+    def _geocode_cache_key(self, query: str, state: Optional[str], limit: int) -> Hashable:
+        # Shared by geocode (no state), geocode_with_state and geocode_batch. A blank
+        # state is still a constraint (one nothing matches), not "no state".
+        if state is None:
+            return self._cache_key(query)
+        return (self._cache_key(query), state.strip().lower(), limit)
+
+    def _batch_request(self, queries: Sequence[str], limit: int) -> Optional[List[Dict]]:
+        joined = ";".join(quote(query, safe="") for query in queries)
+        url = f"{self.BASE_URL}/geocoding/v5/mapbox.places-permanent/{joined}.json"
+        params = {"access_token": self.access_token, "limit": limit, "country": "US"}
+        response = self._session.get(url, params=params, timeout=15)
+        if response.status_code in (401, 403):
+            # The account has no batch access; other errors (429, 414, 422...) are
+            # specific to this request, so only this chunk falls back.
+            self._batch_unsupported.add(self.access_token)
+            return None
+        if response.status_code != 200:
+            return None
+        data = orjson.loads(response.content)
+        # A single query comes back as one FeatureCollection rather than a list.
+        return data if isinstance(data, list) else [data]
+
+    @staticmethod
+    def _match_feature(features: List[Dict], state: Optional[str]) -> Optional[Tuple[float, float]]:
+        if state is None:
+            if not features:
+                return None
+            lon, lat = features[0]["center"]
+            return (lat, lon)
+        state_upper = state.strip().upper()
+        for feat in features:
+            for ctx in feat.get("context", []):
+                if ctx.get("id", "").startswith("region.") and "short_code" in ctx:
+                    if ctx["short_code"].split("-")[-1].upper() == state_upper:
+                        lon, lat = feat["center"]
+                        return (lat, lon)
+                    break
+        return None
+
     def reverse_geocode(self, lat: float, lon: float, timeout: float = 5.0) -> Optional[Dict]:
         """
         Return a dict with city and state short code for a given coordinate.
         Example: {"city": "Bridgeport", "state": "MI"}
         """
+        lat, lon = round(lat, self.REVERSE_PRECISION), round(lon, self.REVERSE_PRECISION)
         cache_key = self._reverse_cache_key(lat, lon)
-        if cache_key in self._reverse_cache:
-            return self._reverse_cache[cache_key]
+        # Shared across processes when CACHES["mapbox"] is (e.g. Redis/Memcached).
+        cached = self._cached(self._reverse_cache, "revgeo", cache_key)
+        if cached is not None:
+            return cached
 
         url = f"{self.BASE_URL}/geocoding/v5/mapbox.places/{lon},{lat}.json"
         params = {
@@ -91,10 +266,10 @@ class MapboxClient:
             "types": "place,region,locality",
             "country": "US",
         }
-        response = requests.get(url, params=params, timeout=timeout)
+        response = self._session.get(url, params=params, timeout=timeout)
         if response.status_code != 200:
             raise MapboxClientError(f"Reverse geocoding failed: {response.text}")
-        data = response.json()
+        data = orjson.loads(response.content)
         features = data.get("features") or []
         if not features:
             return None
@@ -110,16 +285,58 @@ class MapboxClient:
             city = feature.get("text")
         if city and state:
             result = {"city": city, "state": state}
-            self._reverse_cache[cache_key] = result
+            self._remember(self._reverse_cache, "revgeo", cache_key, result, self.REVERSE_CACHE_TIMEOUT)
             return result
         return None
 
+    def reverse_geocode_many(
+        self, coords: Sequence[Tuple[float, float]], return_exceptions: bool = False
+    ) -> List[Union[Optional[Dict], Exception]]:
+        """
+        reverse_geocode for many (lat, lon) points at once, run concurrently on the shared
+        session. With return_exceptions, a failed lookup yields its exception in place
+        (like asyncio.gather) instead of raising.
+        """
+
+        def lookup(coord: Tuple[float, float]) -> Union[Optional[Dict], Exception]:
+            try:
+                return self.reverse_geocode(coord[0], coord[1])
+            except Exception as exc:
+                if not return_exceptions:
+                    raise
+                return exc
+
+        if len(coords) <= 1:
+            return [lookup(coord) for coord in coords]
+        with ThreadPoolExecutor(max_workers=min(self.REVERSE_WORKERS, len(coords))) as pool:
+            return list(pool.map(lookup, coords))
+
     def directions(
         self,
         start: Tuple[float, float],
         end: Tuple[float, float],
+        include_steps: bool = False,
     ) -> Dict:
-        """Fetch driving directions and return the raw Mapbox payload."""
+        """
+        Fetch driving directions and return the route's geometry, distance and duration
+        (plus its legs with turn-by-turn steps when include_steps is set).
+        """
+        # Only the shared tier: geometries are large, so they are not kept in-process.
+        shared = self._shared_cache()
+        shared_key = self._shared_key(
+            "directions",
+            (
+                round(start[0], self.ROUTE_PRECISION),
+                round(start[1], self.ROUTE_PRECISION),
+                round(end[0], self.ROUTE_PRECISION),
+                round(end[1], self.ROUTE_PRECISION),
+                include_steps,
+            ),
+        )
+        cached = shared.get(shared_key) if shared is not None else None
+        if cached is not None:
+            return cached
+
         start_lon, start_lat = start[1], start[0]
         end_lon, end_lat = end[1], end[0]
         coords = f"{start_lon},{start_lat};{end_lon},{end_lat}"
@@ -128,48 +345,45 @@ class MapboxClient:
             "access_token": self.access_token,
             "geometries": "geojson",
             "overview": "full",
-            "steps": "true",
-            "annotations": "distance,duration",
+            "steps": "true" if include_steps else "false",
         }
-        response = requests.get(url, params=params, timeout=15)
+        response = self._session.get(url, params=params, timeout=15)
         if response.status_code != 200:
             raise MapboxClientError(f"Directions failed: {response.text}")
-        payload = response.json()
+        payload = orjson.loads(response.content)
         if not payload.get("routes"):
             raise MapboxClientError("No routes returned by Mapbox.")
-        return payload["routes"][0]
+        full_route = payload["routes"][0]
+        route = {key: full_route[key] for key in ("geometry", "distance", "duration")}
+        if include_steps:
+            route["legs"] = full_route.get("legs", [])
+        if shared is not None:
+            shared.set(shared_key, route, timeout=self.ROUTE_CACHE_TIMEOUT)
+        return route
 
-    def _downsample(self, coordinates: Sequence[Sequence[float]], max_points: int = 200):
-        if len(coordinates) <= max_points:
-            return list(coordinates)
-        step = max(1, len(coordinates) // max_points)
-        reduced = list(coordinates[::step])
-        if reduced[-1] != coordinates[-1]:
-            reduced.append(coordinates[-1])
-        return reduced
+    def _downsample(self, coordinates: Sequence[Sequence[float]], max_points: int = 200) -> np.ndarray:
+        return downsample_polyline(coordinates, max_points=max_points)
 
     def _encode_polyline(self, coordinates: Sequence[Sequence[float]]) -> str:
         """
         Encode a list of [lon, lat] coords into a polyline string (lat, lon order).
         """
-        def _encode(value: int) -> str:
-            value = ~(value << 1) if value < 0 else value << 1
-            chunks = []
-            while value >= 0x20:
-                chunks.append(chr((0x20 | (value & 0x1F)) + 63))
-                value >>= 5
-            chunks.append(chr(value + 63))
-            return "".join(chunks)
-
-        output = []
-        prev_lat = prev_lon = 0
-        for lon, lat in coordinates:
-            lat_i = int(round(lat * 1e5))
-            lon_i = int(round(lon * 1e5))
-            output.append(_encode(lat_i - prev_lat))
-            output.append(_encode(lon_i - prev_lon))
-            prev_lat, prev_lon = lat_i, lon_i
-        return "".join(output)
+        arr = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+        scaled = np.round(arr[:, ::-1] * 1e5).astype(np.int64)  # (lat, lon) rows
+        deltas = np.diff(scaled, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+        values = (deltas << 1) ^ (deltas >> 63)  # branchless zigzag
+
+        # |delta| <= 360e5 fits in 27 bits: at most 6 five-bit chunks per value. Lay the
+        # chunks out as a (values x 6) grid; a value uses every chunk up to its highest
+        # non-zero one, and all but its last used chunk carry the continuation bit.
+        shifted = values[:, None] >> _POLYLINE_SHIFTS
+        used = shifted > 0
+        used[:, 0] = True
+        continued = np.zeros_like(used)
+        continued[:, :-1] = used[:, 1:]
+        chunks = shifted & 0x1F
+        np.bitwise_or(chunks, 0x20, out=chunks, where=continued)
+        return (chunks[used] + 63).astype(np.uint8).tobytes().decode("ascii")
 
     def build_static_map_url(
         self,
@@ -181,23 +395,26 @@ class MapboxClient:
         height: int = 400,
     ) -> str:
         """Return a Mapbox static map URL with the route and stops drawn."""
-        coords = geometry.get("coordinates") or []
-        downsampled = self._downsample(coords, max_points=180)
-        encoded = self._encode_polyline(downsampled)
-        path_overlay = f"path-4+0066ff-0.7({quote(encoded, safe='')})"
+        coords = np.asarray(geometry.get("coordinates") or [], dtype=np.float64).reshape(-1, 2)
+        # The route path is the expensive part to build; pins and the token are not cached.
+        # Keyed by a digest of every coordinate: routes sharing endpoints must not collide.
+        digest = hashlib.blake2b(coords.tobytes(), digest_size=16).hexdigest()
+        path_overlay = self._cached(self._path_cache, "staticpath", digest)
+        if path_overlay is None:
+            downsampled = self._downsample(coords, max_points=180)
+            encoded = self._encode_polyline(downsampled)
+            path_overlay = f"path-4+0066ff-0.7({quote(encoded, safe='')})"
+            self._remember(self._path_cache, "staticpath", digest, path_overlay, self.ROUTE_CACHE_TIMEOUT)
 
-        pin_overlays = []
+        # Pins at 5 decimals (~1m) keep long-route URLs under Mapbox's 8KB limit.
+        pins = []
         if start_point:
-            s_lat, s_lon = start_point
-            pin_overlays.append(f"pin-s-a+00aa55({s_lon},{s_lat})")
+            pins.append(f"pin-s-a+00aa55({round(start_point[1], 5)},{round(start_point[0], 5)})")
         if end_point:
-            e_lat, e_lon = end_point
-            pin_overlays.append(f"pin-s-b+111111({e_lon},{e_lat})")
-        if stop_points:
-            for lat, lon in stop_points:
-                pin_overlays.append(f"pin-s+f44({lon},{lat})")
+            pins.append(f"pin-s-b+111111({round(end_point[1], 5)},{round(end_point[0], 5)})")
+        pins += [f"pin-s+f44({round(lon, 5)},{round(lat, 5)})" for lat, lon in stop_points or ()]
 
-        overlay = ",".join([path_overlay, *pin_overlays])
+        overlay = ",".join([path_overlay, *pins])
         return (
             f"{self.BASE_URL}/styles/v1/mapbox/streets-v12/static/"
             f"{overlay}/auto/{width}x{height}"
@@ -0,0 +1,91 @@
+import math
+import threading
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from .geometry import EARTH_RADIUS_MILES
+
+MILES_PER_DEGREE_LAT = EARTH_RADIUS_MILES * math.pi / 180
+
+
+class GridIndex:
+    """
+    Bucket index of points on a fixed lat/lon degree grid.
+
+    Points can be added at any time (stations get coordinates lazily as they are
+    geocoded), and radius queries only visit the cells overlapping the query's
+    bounding box. Results are a superset of the points within the radius; callers
+    still measure exact distances on the returned ids. Longitude wrap-around at the
+    antimeridian is not handled, which is fine for US routes. Safe to share between
+    threads: adds and queries take a lock.
+    """
+
+    def __init__(self, cell_degrees: float = 1.0):
+        self.cell_degrees = cell_degrees
+        self._cells: Dict[Tuple[int, int], List[int]] = {}
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return (math.floor(lat / self.cell_degrees), math.floor(lon / self.cell_degrees))
+
+    def add(self, idx: int, lat: float, lon: float) -> None:
+        with self._lock:
+            self._cells.setdefault(self._cell(lat, lon), []).append(idx)
+            self._count += 1
+
+    def __len__(self) -> int:
+        return self._count
+
+    def query_radius(self, lat: float, lon: float, radius_miles: float) -> np.ndarray:
+        """Return ids of every point in cells overlapping the radius' bounding box."""
+        lat_margin = radius_miles / MILES_PER_DEGREE_LAT
+        max_abs_lat = min(abs(lat) + lat_margin, 89.0)
+        lon_margin = radius_miles / (MILES_PER_DEGREE_LAT * max(math.cos(math.radians(max_abs_lat)), 0.01))
+        lo_row, lo_col = self._cell(lat - lat_margin, lon - lon_margin)
+        hi_row, hi_col = self._cell(lat + lat_margin, lon + lon_margin)
+        ids: List[int] = []
+        with self._lock:
+            if (hi_row - lo_row + 1) * (hi_col - lo_col + 1) > len(self._cells):
+                # Huge radius: cheaper to filter the occupied cells than to walk the box.
+                for (row, col), bucket in self._cells.items():
+                    if lo_row <= row <= hi_row and lo_col <= col <= hi_col:
+                        ids.extend(bucket)
+            else:
+                for row in range(lo_row, hi_row + 1):
+                    for col in range(lo_col, hi_col + 1):
+                        ids.extend(self._cells.get((row, col), ()))
+        return np.asarray(ids, dtype=np.intp)
+
+    def query_boxes(
+        self, lo_lats: np.ndarray, lo_lons: np.ndarray, hi_lats: np.ndarray, hi_lons: np.ndarray
+    ) -> np.ndarray:
+        """Return sorted ids of every point in cells overlapping any of the given boxes."""
+        lo_rows = np.floor(np.asarray(lo_lats) / self.cell_degrees).astype(np.int64)
+        hi_rows = np.floor(np.asarray(hi_lats) / self.cell_degrees).astype(np.int64)
+        lo_cols = np.floor(np.asarray(lo_lons) / self.cell_degrees).astype(np.int64)
+        hi_cols = np.floor(np.asarray(hi_lons) / self.cell_degrees).astype(np.int64)
+        ids: List[int] = []
+        with self._lock:
+            if int(((hi_rows - lo_rows + 1) * (hi_cols - lo_cols + 1)).sum()) > len(self._cells):
+                # Boxes cover more cells than are occupied: test the occupied ones instead.
+                occupied = list(self._cells)
+                rows, cols = np.asarray(occupied, dtype=np.int64).reshape(-1, 2).T
+                hit = (
+                    (rows[:, None] >= lo_rows) & (rows[:, None] <= hi_rows)
+                    & (cols[:, None] >= lo_cols) & (cols[:, None] <= hi_cols)
+                ).any(axis=1)
+                for pos in np.flatnonzero(hit):
+                    ids.extend(self._cells[occupied[pos]])
+            else:
+                cells = set()
+                for lo_row, hi_row, lo_col, hi_col in zip(
+                    lo_rows.tolist(), hi_rows.tolist(), lo_cols.tolist(), hi_cols.tolist()
+                ):
+                    for row in range(lo_row, hi_row + 1):
+                        for col in range(lo_col, hi_col + 1):
+                            cells.add((row, col))
+                for cell in cells:
+                    ids.extend(self._cells.get(cell, ()))
+        return np.sort(np.asarray(ids, dtype=np.intp))
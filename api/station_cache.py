@@ -0,0 +1,215 @@
+import logging
+import math
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple
+
+import orjson
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class StationCache:
+    """
+    Persistent map of FuelStation.cache_key -> (lat, lon) for geocoded stations.
+
+    Stored as an append-only JSON Lines log: each set() appends one
+    {"key": [lat, lon]} line instead of rewriting the file, and load() replays
+    the log with last-write-wins. compact() rewrites the log once.
+
+    Several processes may share one log. Appends hold a shared flock on a sidecar
+    `.lock` file and compaction holds it exclusively, re-reading the log first so
+    other processes' appends survive; writers reopen the log when compaction has
+    swapped in a new file. Without fcntl, load() never compacts on its own.
+
+    Persistence is opt-in: with no path (STATION_CACHE_PATH unset) the cache only
+    lives in memory. It is also best-effort: if the log can't be read or written (e.g.
+    a read-only app directory), a warning is logged and the cache carries on in memory.
+    """
+
+    # Compact on load once superseded lines outnumber live entries by this factor.
+    COMPACT_RATIO = 2
+
+    def __init__(self, path: Optional[str] = None):
+        path = path or settings.STATION_CACHE_PATH
+        self.path: Optional[Path] = Path(path) if path else None
+        self._data: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+        self._handle = None
+        self._lock_handle = None
+        self._persist = self.path is not None
+        self.load()
+
+    def load(self) -> None:
+        if not self._persist:
+            return
+        try:
+            data, lines, torn = self._read_log()
+        except OSError as exc:
+            self._disable_persistence(exc)
+            return
+        with self._lock:
+            self._data = data
+        if fcntl is None:
+            return
+        # Compacting also drops a torn tail so the next append starts on a fresh line.
+        if torn or lines > self.COMPACT_RATIO * max(len(data), 1):
+            self.compact()
+
+    def get(self, key: str) -> Optional[Tuple[float, float]]:
+        return self._data.get(key)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Tuple[float, float]]:
+        """Return the cached coords for whichever of `keys` are present."""
+        data = self._data
+        return {key: data[key] for key in keys if key in data}
+
+    def set(self, key: str, coords: Tuple[float, float]) -> None:
+        with self._lock:
+            if self._data.get(key) == coords:
+                return
+            self._data[key] = coords
+            if not self._persist:
+                return
+            try:
+                with self._file_lock(exclusive=False):
+                    handle = self._open_for_append()
+                    handle.write(orjson.dumps({key: coords}) + b"\n")
+                    handle.flush()
+            except OSError as exc:
+                self._disable_persistence(exc)
+
+    def compact(self) -> None:
+        """Rewrite the log so it holds exactly one line per cached station."""
+        with self._lock:
+            if not self._persist:
+                return
+            try:
+                with self._file_lock(exclusive=True):
+                    self._close_handle()
+                    # Re-read under the lock: other processes may have appended since load().
+                    data, _, _ = self._read_log()
+                    self._data = {**self._data, **data}
+                    self.path.parent.mkdir(parents=True, exist_ok=True)
+                    tmp_path = self.path.with_name(self.path.name + ".tmp")
+                    tmp_path.write_bytes(
+                        b"".join(orjson.dumps({key: coords}) + b"\n" for key, coords in self._data.items())
+                    )
+                    os.replace(tmp_path, self.path)
+            except OSError as exc:
+                self._disable_persistence(exc)
+
+    def close(self) -> None:
+        with self._lock:
+            self._close_handle()
+            if self._lock_handle is not None:
+                self._lock_handle.close()
+                self._lock_handle = None
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _read_log(self) -> Tuple[Dict[str, Tuple[float, float]], int, bool]:
+        """Replay the log: (data, parsed line count, whether a torn line was skipped)."""
+        data: Dict[str, Tuple[float, float]] = {}
+        lines = 0
+        torn = False
+        if self.path.exists():
+            with open(self.path, "rb") as fp:
+                for line in fp:
+                    try:
+                        entry = self._parse_entry(line)
+                    except (orjson.JSONDecodeError, TypeError, ValueError):
+                        # A partial line from an interrupted append, or one that isn't a
+                        # {key: [lat, lon]} entry; compaction drops it.
+                        torn = True
+                        continue
+                    data.update(entry)
+                    lines += 1
+        return data, lines, torn
+
+    @staticmethod
+    def _parse_entry(line: bytes) -> Dict[str, Tuple[float, float]]:
+        """Parse one log line; raises TypeError/ValueError unless it maps keys to finite (lat, lon)."""
+        entry = orjson.loads(line)
+        if not isinstance(entry, dict):
+            raise TypeError("log entry is not an object")
+        parsed = {}
+        for key, coords in entry.items():
+            if not isinstance(coords, list) or len(coords) != 2:
+                raise TypeError("coordinates are not a [lat, lon] pair")
+            lat, lon = float(coords[0]), float(coords[1])
+            if not (math.isfinite(lat) and math.isfinite(lon)):
+                raise ValueError("coordinates are not finite")
+            parsed[key] = (lat, lon)
+        return parsed
+
+    def _disable_persistence(self, exc: OSError) -> None:
+        # Callers hold self._lock (or are still in __init__).
+        logger.warning("Station cache %s is not usable, keeping coordinates in memory only: %s", self.path, exc)
+        self._persist = False
+        self._close_handle()
+        if self._lock_handle is not None:
+            self._lock_handle.close()
+            self._lock_handle = None
+
+    @contextmanager
+    def _file_lock(self, exclusive: bool):
+        """flock the sidecar `.lock` file; raises OSError if it can't be created or locked."""
+        if fcntl is None:
+            yield
+            return
+        if self._lock_handle is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._lock_handle = open(self.path.with_name(self.path.name + ".lock"), "ab")
+        fcntl.flock(self._lock_handle, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            try:
+                fcntl.flock(self._lock_handle, fcntl.LOCK_UN)
+            except OSError:
+                pass  # closing the handle releases the lock anyway
+
+    def _open_for_append(self):
+        if self._handle is not None:
+            # Another process may have compacted the log into a new file; appending
+            # to the old, unlinked inode would lose the write.
+            try:
+                replaced = os.stat(self.path).st_ino != os.fstat(self._handle.fileno()).st_ino
+            except FileNotFoundError:
+                replaced = True
+            if replaced:
+                self._close_handle()
+        if self._handle is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._handle = open(self.path, "ab")
+        return self._handle
+
+    def _close_handle(self) -> None:
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+
+_station_cache: Optional[StationCache] = None
+_station_cache_lock = threading.Lock()
+
+
+def get_station_cache() -> StationCache:
+    """Process-wide StationCache so every request shares one log handle."""
+    global _station_cache
+    if _station_cache is None:
+        with _station_cache_lock:
+            if _station_cache is None:
+                _station_cache = StationCache()
+    return _station_cache
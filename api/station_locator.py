@@ -1,50 +1,95 @@
-from typing import Dict, Iterable, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
-from .geometry import haversine_miles
+from .geometry import distances_to_point_miles, haversine_miles, haversine_miles_array
 from .mapbox_client import MapboxClient
-from .fuel_data import FuelStation, stations_sorted_by_price
-from .geometry import nearest_point_distance_miles
-from math import inf
+from .fuel_data import FuelCatalog, FuelStation, city_state_key, state_key
+from .spatial_index import MILES_PER_DEGREE_LAT
+from .station_cache import StationCache
+from .geometry import PolylineSegments, nearest_point_distances_miles, polyline_segments
 from itertools import islice
 
+import numpy as np
+
 
 class StationLocator:
+    NEAREST_SEARCH_START_MILES = 50.0
+    NEAREST_SEARCH_MAX_MILES = 3200.0
+    ROUTE_BOUND_SEARCH_MILES = 50.0  # grid radius around sampled vertices in nearest_on_route
+    GEOCODE_WORKERS = 8  # concurrent Mapbox lookups while scanning for a cheaper station
+
     def __init__(
         self,
-        stations: Iterable[FuelStation],
+        catalog: FuelCatalog,
         mapbox_client: MapboxClient,
-        city_state_index: Optional[Dict[str, List[FuelStation]]] = None,
-        state_index: Optional[Dict[str, List[FuelStation]]] = None,
+        station_cache: Optional[StationCache] = None,
+        keep: Optional[np.ndarray] = None,
     ):
-        self.stations = list(stations)
-        self.sorted_by_price = stations_sorted_by_price(self.stations)
-        self.city_state_index = city_state_index or {}
-        self.state_index = state_index or {}
+        """
+        `keep` optionally masks catalog positions (e.g. to the route's bounding box). It
+        only narrows the city/state and state candidate pools, whose picks must lie
+        within the search radius anyway; the price order and the nearest-station
+        fallbacks see the whole catalog.
+
+        The catalog is shared by every request and learns station locations as they
+        are geocoded, so answers improve as it fills in: a request can pick a different
+        (nearer or cheaper) station after other requests have located more stations.
+        Only back-to-back identical requests are stable.
+        """
+        self.catalog = catalog
+        self.stations = catalog.stations
+        self.city_state_index = catalog.city_state_index
+        self.state_index = catalog.state_index
         self.mapbox = mapbox_client
-        self._session_coords: Dict[str, Tuple[float, float]] = {}
+        self.cache = station_cache
+        self._keys = catalog.keys
+        # Index pools normally hold these very objects; identity avoids formatting keys.
+        self._positions_by_id = catalog.positions_by_id
+        if self.cache is not None:
+            # Apply persisted coordinates up front so the arrays and grid start out complete.
+            catalog.apply_cached_coords(self.cache)
+        # Shared with every other request through the catalog, and kept current by it.
+        self._lats, self._lons, self._prices = catalog.lats, catalog.lons, catalog.prices
+        self._grid = catalog.grid
+        self._by_price = catalog.by_price
+        self._price_rank = catalog.price_rank
+        self.sorted_by_price = catalog.sorted_by_price
+        self._keep = keep
+        # Index pools narrowed by `keep`, keyed by the pool list's identity: the planner
+        # passes these lists back as candidates, so each is masked at most once.
+        self._index_positions: Dict[int, np.ndarray] = {}
+
+    def _record_coords(self, station: FuelStation, coords: Tuple[float, float]) -> None:
+        self.catalog.record_coords(self._position(station), coords)
 
     def _ensure_coords(
         self, station: FuelStation, allow_geocode: bool = False
     ) -> Tuple[Optional[Tuple[float, float]], bool]:
         """
         Returns (coords, attempted_geocode_flag).
+        Persisted coordinates are already in the catalog (see apply_cached_coords).
         """
-        if station.coordinates:
-            return station.coordinates, False
-        if station.cache_key in self._session_coords:
-            coords = self._session_coords[station.cache_key]
-            station.coordinates = coords
+        coords = station.coordinates
+        if coords:
             return coords, False
         if not allow_geocode:
             return None, False
+        return self._geocode_cascade(station, self._geocode_queries(station)), True
+
+    @staticmethod
+    def _geocode_queries(station: FuelStation) -> List[Tuple[str, bool]]:
         # Try multiple queries to disambiguate similarly named cities/states.
         # Prefer state-matching geocode to disambiguate similarly named cities.
-        queries = [
+        return [
             (f"{station.address}, {station.city}, {station.state}, USA", True),
             (f"{station.city}, {station.state}, USA", True),
             (f"{station.city}, USA", False),
             (f"{station.state}, USA", False),
         ]
+
+    def _geocode_cascade(
+        self, station: FuelStation, queries: Sequence[Tuple[str, bool]]
+    ) -> Optional[Tuple[float, float]]:
         for q, enforce_state in queries:
             coords = (
                 self.mapbox.geocode_with_state(q, station.state)
@@ -52,23 +97,94 @@ class StationLocator:
                 else self.mapbox.geocode(q)
             )
             if coords:
-                station.coordinates = coords
-                self._session_coords[station.cache_key] = coords
-                return coords, True
+                self._store_geocoded(station, coords)
+                return coords
+        return None
 
-        return None, True
+    def _geocode_after_address(self, station: FuelStation) -> Optional[Tuple[float, float]]:
+        return self._geocode_cascade(station, self._geocode_queries(station)[1:])
+
+    def _store_geocoded(self, station: FuelStation, coords: Tuple[float, float]) -> None:
+        self._record_coords(station, coords)
+        if self.cache is not None:
+            self.cache.set(self._key(station), coords)
 
     def stations_for_city_state(self, city: Optional[str], state: Optional[str]) -> List[FuelStation]:
         if not city or not state:
             return []
-        key = f"{city.lower().strip()}|{state.lower().strip()}"
-        return self.city_state_index.get(key, [])
+        return self.city_state_index.get(city_state_key(city, state), [])
 
     def stations_for_state(self, state: Optional[str]) -> List[FuelStation]:
         if not state:
             return []
-        key = state.lower().strip()
-        return self.state_index.get(key, [])
+        return self.state_index.get(state_key(state), [])
+
+    def _position(self, station: FuelStation) -> int:
+        return self.catalog.position(station)
+
+    def _key(self, station: FuelStation) -> str:
+        idx = self._positions_by_id.get(id(station))
+        return self._keys[idx] if idx is not None else station.cache_key
+
+    def _pool_positions(self, pool: List[FuelStation]) -> np.ndarray:
+        """Cheapest-first positions of a candidate pool, narrowed by `keep`."""
+        positions = self._index_positions.get(id(pool))
+        if positions is None:
+            positions = self.catalog.pool_positions(pool)
+            if self._keep is not None:
+                positions = positions[self._keep[positions]]
+            if id(pool) in self.catalog.index_pool_ids:
+                self._index_positions[id(pool)] = positions
+        return positions
+
+    def cheapest_for_markers(
+        self,
+        markers: np.ndarray,
+        radius_miles: float,
+        candidates: Optional[Sequence[Optional[List[FuelStation]]]] = None,
+        chunk_size: int = 256,
+    ) -> np.ndarray:
+        """
+        For each (lat, lon) marker row, return the index into self.stations of the cheapest
+        station with known coordinates within radius_miles, or -1 when there is none.
+        `candidates` optionally restricts each marker to its own station pool.
+        Markers are processed in chunks; each chunk's distances form one (markers x
+        stations) matrix over the stations the grid index places near those markers.
+        """
+        markers = np.asarray(markers, dtype=np.float64).reshape(-1, 2)
+        candidates = list(candidates or [])
+        best = np.full(len(markers), -1, dtype=np.intp)
+        for start in range(0, len(markers), chunk_size):
+            best[start:start + chunk_size] = self._cheapest_for_chunk(
+                markers[start:start + chunk_size], radius_miles, candidates[start:start + chunk_size]
+            )
+        return best
+
+    def _cheapest_for_chunk(
+        self,
+        markers: np.ndarray,
+        radius_miles: float,
+        candidates: Sequence[Optional[List[FuelStation]]],
+    ) -> np.ndarray:
+        best = np.full(len(markers), -1, dtype=np.intp)
+        columns = np.unique(
+            np.concatenate([self._grid.query_radius(lat, lon, radius_miles) for lat, lon in markers])
+        )
+        if not len(columns):
+            return best
+        allowed = np.ones((len(markers), len(columns)), dtype=bool)
+        for row, pool in enumerate(candidates):
+            if pool is not None:
+                allowed[row] = np.isin(columns, self._pool_positions(pool))
+        distances = haversine_miles_array(
+            markers[:, :1], markers[:, 1:], self._lats[columns][None, :], self._lons[columns][None, :]
+        )
+        hits = allowed & (distances <= radius_miles)
+        ranks = np.where(hits, self._price_rank[columns][None, :], np.iinfo(np.int32).max)
+        cheapest = np.argmin(ranks, axis=1)
+        found = hits[np.arange(len(markers)), cheapest]
+        best[found] = columns[cheapest[found]]
+        return best
 
     def cheapest_nearby(
         self,
@@ -77,38 +193,105 @@ class StationLocator:
         allow_geocode: bool,
         geocode_budget: int,
         candidates: Optional[List[FuelStation]] = None,
+        known_best: Optional[int] = None,
     ) -> Optional[FuelStation]:
         """
         Return the cheapest station within radius_miles of the target.
         Will attempt geocoding until budget is exhausted.
+        `known_best` is this target's cheapest_for_markers result, if already computed.
         """
-        budget_left = geocode_budget
-        cheapest: Optional[FuelStation] = None
-        pool = candidates if candidates is not None else self.sorted_by_price
-        pool = stations_sorted_by_price(pool)  # ensure cheapest-first
-        for station in pool:
-            coords, attempted = self._ensure_coords(
-                station, allow_geocode=allow_geocode and budget_left > 0
-            )
-            if attempted:
-                budget_left -= 1
-            if coords is None:
-                continue
-            if haversine_miles(coords, target) <= radius_miles:
-                cheapest = station
-                break
+        budget_left = geocode_budget if allow_geocode else 0
+        if known_best is None:
+            known_best = int(self.cheapest_for_markers([target], radius_miles, [candidates])[0])
+        positions = self._pool_positions(candidates) if candidates is not None else self._by_price
+        # Only stations cheaper than the best already-located match need a geocoding look.
+        if known_best >= 0:
+            positions = positions[: np.searchsorted(self._price_rank[positions], self._price_rank[known_best])]
+        cheapest, used = self._scan_in_waves(
+            (self.stations[idx] for idx in positions), target, radius_miles, budget_left
+        )
+        budget_left -= used
+        if cheapest is None and known_best >= 0:
+            cheapest = self.stations[known_best]
         if cheapest:
             return cheapest
 
         # Secondary fallback: try geocoding a small slice of the global cheapest
         # stations if we haven't used the budget.
-        if allow_geocode and budget_left > 0:
-            for station in islice(self.sorted_by_price, budget_left):
-                coords, attempted = self._ensure_coords(station, allow_geocode=True)
-                if not coords:
+        if budget_left > 0:
+            return self._scan_in_waves(
+                islice(self.sorted_by_price, budget_left), target, radius_miles, budget_left
+            )[0]
+        return None
+
+    def _scan_in_waves(
+        self,
+        stations: Iterable[FuelStation],
+        target: Tuple[float, float],
+        radius_miles: float,
+        budget: int,
+    ) -> Tuple[Optional[FuelStation], int]:
+        """
+        Return (first of `stations` within radius_miles of target, geocodes used), geocoding
+        at most `budget` unlocated stations on the way.
+
+        Unlocated stations are geocoded concurrently in waves that start at one station
+        and double up to GEOCODE_WORKERS; a located in-range station closes a wave early.
+        Each wave is checked in order, so the winner is the one a one-by-one scan finds
+        and a scan without a winner geocodes exactly as much. When there is a winner,
+        the rest of its wave is speculative: fewer than GEOCODE_WORKERS extra lookups.
+        """
+        used = 0
+        wave_size = 1
+        wave: List[FuelStation] = []
+        pending: List[FuelStation] = []
+        for station in stations:
+            coords, _ = self._ensure_coords(station)
+            if coords is None:
+                if used + len(pending) >= budget:
                     continue
-                if haversine_miles(coords, target) <= radius_miles:
-                    return station
+                pending.append(station)
+            wave.append(station)
+            in_range = coords is not None and haversine_miles(coords, target) <= radius_miles
+            if in_range or len(pending) >= wave_size:
+                found = self._first_within(wave, pending, target, radius_miles)
+                used += len(pending)
+                if found:
+                    return found, used
+                wave, pending = [], []
+                wave_size = min(wave_size * 2, self.GEOCODE_WORKERS)
+        if wave:
+            found = self._first_within(wave, pending, target, radius_miles)
+            return found, used + len(pending)
+        return None, used
+
+    def _first_within(
+        self,
+        wave: Sequence[FuelStation],
+        pending: Sequence[FuelStation],
+        target: Tuple[float, float],
+        radius_miles: float,
+    ) -> Optional[FuelStation]:
+        """Geocode `pending` concurrently, then return the first station of `wave` in range."""
+        if len(pending) == 1:
+            self._ensure_coords(pending[0], allow_geocode=True)
+        elif pending:
+            # Address lookups for the whole wave go out as one batch request; only the
+            # misses walk the rest of the query cascade, concurrently.
+            first = [self._geocode_queries(station)[0][0] for station in pending]
+            located = self.mapbox.geocode_batch(first, states=[station.state for station in pending])
+            misses = []
+            for station, coords in zip(pending, located):
+                if coords:
+                    self._store_geocoded(station, coords)
+                else:
+                    misses.append(station)
+            if misses:
+                with ThreadPoolExecutor(max_workers=min(len(misses), self.GEOCODE_WORKERS)) as pool:
+                    list(pool.map(self._geocode_after_address, misses))
+        for station in wave:
+            if station.coordinates and haversine_miles(station.coordinates, target) <= radius_miles:
+                return station
         return None
 
     def cheapest_with_coords(self) -> Optional[FuelStation]:
@@ -119,38 +302,83 @@ class StationLocator:
         return None
 
     def nearest_on_route(
-        self, polyline: List[List[float]], max_distance_miles: Optional[float] = None
+        self,
+        polyline: Union[List[List[float]], PolylineSegments],
+        max_distance_miles: Optional[float] = None,
     ) -> Optional[FuelStation]:
         """
         Return the station with coordinates closest to the given polyline.
         If max_distance_miles is set, ignore stations farther than that.
         """
-        closest_station = None
-        closest_distance = inf
-        for station in self.stations:
-            coords, _ = self._ensure_coords(station, allow_geocode=False)
-            if not coords:
-                continue
-            distance = nearest_point_distance_miles(coords, polyline)
-            if max_distance_miles is not None and distance > max_distance_miles:
-                continue
-            if distance < closest_distance:
-                closest_distance = distance
-                closest_station = station
-        return closest_station
+        if not isinstance(polyline, PolylineSegments):
+            polyline = polyline_segments(polyline)
+        return self.nearest_on_route_prepared(polyline, max_distance_miles)
+
+    def nearest_on_route_prepared(
+        self, segments: PolylineSegments, max_distance_miles: Optional[float] = None
+    ) -> Optional[FuelStation]:
+        """
+        nearest_on_route for a polyline whose segment arrays were built once by the caller.
+        A station near a sampled vertex bounds the answer, so only stations in grid cells
+        within that bound of some segment's bounding box are measured.
+        """
+        if not len(segments.dx) or not len(self._grid):
+            return None
+        bound = self._route_distance_bound(segments)
+        if max_distance_miles is not None:
+            bound = min(bound, max_distance_miles)
+        if np.isfinite(bound):
+            # Slack covers the kernel ranking segments with an equirectangular metric.
+            bound = bound * 1.01 + 0.1
+            lat_margin = bound / MILES_PER_DEGREE_LAT
+            lo_lat = np.minimum(segments.lat1, segments.lat1 + segments.dy) - lat_margin
+            hi_lat = np.maximum(segments.lat1, segments.lat1 + segments.dy) + lat_margin
+            max_abs_lat = np.minimum(np.maximum(np.abs(lo_lat), np.abs(hi_lat)), 89.0)
+            lon_margin = lat_margin / np.maximum(np.cos(np.radians(max_abs_lat)), 0.01)
+            lo_lon = np.minimum(segments.lon1, segments.lon1 + segments.dx) - lon_margin
+            hi_lon = np.maximum(segments.lon1, segments.lon1 + segments.dx) + lon_margin
+            candidates = self._grid.query_boxes(lo_lat, lo_lon, hi_lat, hi_lon)
+        else:
+            candidates = np.flatnonzero(~np.isnan(self._lats))
+        if not len(candidates):
+            return None
+        distances = nearest_point_distances_miles(self._lats[candidates], self._lons[candidates], segments)
+        best = int(np.argmin(distances))
+        if not np.isfinite(distances[best]):
+            return None
+        if max_distance_miles is not None and distances[best] > max_distance_miles:
+            return None
+        return self.stations[candidates[best]]
+
+    def _route_distance_bound(self, segments: PolylineSegments, samples: int = 16) -> float:
+        """Distance from some located station to a sampled route vertex; inf if none is near."""
+        vertices = segments.points[:: max(1, len(segments.points) // samples)]
+        ids = np.unique(np.concatenate([
+            self._grid.query_radius(lat, lon, self.ROUTE_BOUND_SEARCH_MILES) for lon, lat in vertices
+        ]))
+        if not len(ids):
+            return np.inf
+        return float(haversine_miles_array(
+            vertices[:, 1:2], vertices[:, 0:1], self._lats[ids], self._lons[ids]
+        ).min())
 
     def nearest_to_point(self, target: Tuple[float, float]) -> Optional[FuelStation]:
         """
         Return the station with coordinates closest to a specific point.
+        Searches the grid index in growing radii; a hit within the searched radius is
+        the global nearest since everything outside it is farther away.
         """
-        closest_station = None
-        closest_distance = inf
-        for station in self.stations:
-            coords, _ = self._ensure_coords(station, allow_geocode=False)
-            if not coords:
-                continue
-            dist = haversine_miles(coords, target)
-            if dist < closest_distance:
-                closest_distance = dist
-                closest_station = station
-        return closest_station
+        radius = self.NEAREST_SEARCH_START_MILES
+        while radius <= self.NEAREST_SEARCH_MAX_MILES:
+            ids = np.sort(self._grid.query_radius(target[0], target[1], radius))  # ties -> lowest index
+            if len(ids):
+                distances = distances_to_point_miles(target[0], target[1], self._lats[ids], self._lons[ids])
+                best = int(np.argmin(distances))
+                if distances[best] <= radius:
+                    return self.stations[ids[best]]
+            radius *= 4
+        known = np.flatnonzero(~np.isnan(self._lats))
+        if not len(known):
+            return None
+        distances = distances_to_point_miles(target[0], target[1], self._lats[known], self._lons[known])
+        return self.stations[known[int(np.argmin(distances))]]
@@ -0,0 +1,713 @@
+import math
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest import mock
+from urllib.parse import unquote
+
+import numpy as np
+import orjson
+from django.core.cache import caches
+from django.test import SimpleTestCase, override_settings
+
+from . import fuel_data
+from .fuel_data import FuelCatalog, FuelStation, load_fuel_stations
+from .fuel_optimizer import build_mile_markers
+from .geometry import downsample_polyline, haversine_miles, nearest_point_distance_miles
+from .geometry import nearest_point_distances_miles, polyline_segments
+from .mapbox_client import MapboxClient
+from .spatial_index import GridIndex
+from .station_cache import StationCache
+from .station_locator import StationLocator
+from .ttl_cache import TTLCache
+
+
+def _reference_encode(coordinates):
+    """Straightforward per-value polyline encoder, as in Google's algorithm description."""
+    out = []
+    prev_lat = prev_lon = 0
+    for lon, lat in coordinates:
+        lat_i, lon_i = round(lat * 1e5), round(lon * 1e5)
+        for delta in (lat_i - prev_lat, lon_i - prev_lon):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                out.append(chr((0x20 | (value & 0x1F)) + 63))
+                value >>= 5
+            out.append(chr(value + 63))
+        prev_lat, prev_lon = lat_i, lon_i
+    return "".join(out)
+
+
+class EncodePolylineTests(SimpleTestCase):
+    def setUp(self):
+        self.client = MapboxClient("test-token")
+
+    def test_known_example(self):
+        coords = [[-120.2, 38.5], [-120.95, 40.7], [-126.453, 43.252]]
+        self.assertEqual(self.client._encode_polyline(coords), "_p~iF~ps|U_ulLnnqC_mqNvxq`@")
+
+    def test_matches_reference_encoder(self):
+        rng = random.Random(3)
+        for _ in range(50):
+            coords = [
+                [rng.uniform(-180, 180), rng.uniform(-90, 90)] for _ in range(rng.randint(1, 60))
+            ]
+            self.assertEqual(self.client._encode_polyline(coords), _reference_encode(coords))
+
+    def test_small_and_zero_deltas(self):
+        coords = [[-74.0, 40.7], [-74.0, 40.7], [-74.00001, 40.70001], [-73.99999, 40.69999]]
+        self.assertEqual(self.client._encode_polyline(coords), _reference_encode(coords))
+
+    def test_empty(self):
+        self.assertEqual(self.client._encode_polyline([]), "")
+
+
+def _feature(lat, lon, state):
+    return {"center": [lon, lat], "context": [{"id": "region.1", "short_code": f"US-{state}"}]}
+
+
+class GeocodeBatchTests(SimpleTestCase):
+    PLACES = {
+        "1 Main St, Austin, TX": (30.27, -97.74, "TX"),
+        "2 Main St, Tulsa, OK": (36.15, -95.99, "OK"),
+        "3 Main St, Wichita, KS": (37.69, -97.34, "KS"),
+    }
+
+    def setUp(self):
+        for name, value in (("_geocode_cache", TTLCache(100, 60)), ("_batch_unsupported", set())):
+            patcher = mock.patch.object(MapboxClient, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = MapboxClient("test-token")
+        self.client._session = mock.Mock()
+        self.client._session.get.side_effect = self._respond
+        self.batch_status = 200
+        self.batch_size = None  # collections in a batch reply; None answers every query
+        self.batch_calls = []
+        self.single_calls = []
+
+    def _collection(self, query):
+        lat, lon, state = self.PLACES[query]
+        return {"type": "FeatureCollection", "features": [_feature(lat, lon, state)]}
+
+    def _respond(self, url, params, timeout):
+        queries = [unquote(query) for query in url.rsplit("/", 1)[1][:-len(".json")].split(";")]
+        if "places-permanent" in url:
+            self.batch_calls.append(queries)
+            if self.batch_status != 200:
+                return mock.Mock(status_code=self.batch_status, content=b"", text="refused")
+            collections = [self._collection(query) for query in queries][:self.batch_size]
+            data = collections[0] if len(queries) == 1 else collections
+        else:
+            self.single_calls.extend(queries)
+            data = self._collection(queries[0])
+        return mock.Mock(status_code=200, content=orjson.dumps(data), text="")
+
+    def test_batch_reply_matches_features_by_state(self):
+        queries = list(self.PLACES)
+        found = self.client.geocode_batch(queries, states=["TX", "TX", None])
+        self.assertEqual(found, [(30.27, -97.74), None, (37.69, -97.34)])
+        self.assertEqual(self.batch_calls, [queries])
+        self.assertEqual(self.single_calls, [])
+
+    def test_single_query_reply_is_one_collection(self):
+        found = self.client.geocode_batch(["2 Main St, Tulsa, OK"], states=["OK"])
+        self.assertEqual(found, [(36.15, -95.99)])
+        self.assertEqual(len(self.batch_calls), 1)
+        self.assertEqual(self.single_calls, [])
+
+    def test_unauthorized_batch_falls_back_and_is_not_retried(self):
+        for status in (401, 403):
+            MapboxClient._batch_unsupported.clear()
+            self.client._geocode_cache.clear()
+            self.batch_status, self.batch_calls, self.single_calls = status, [], []
+            queries = list(self.PLACES)
+            expected = [place[:2] for place in self.PLACES.values()]
+            self.assertEqual(self.client.geocode_batch(queries, states=["TX", "OK", "KS"]), expected)
+            self.client._geocode_cache.clear()
+            self.assertEqual(self.client.geocode_batch(queries), expected)
+            self.assertEqual(len(self.batch_calls), 1)
+            self.assertEqual(sorted(self.single_calls), sorted(queries * 2))
+
+    def test_other_batch_errors_fall_back_for_that_request_only(self):
+        self.batch_status = 429
+        queries = list(self.PLACES)
+        expected = [place[:2] for place in self.PLACES.values()]
+        self.assertEqual(self.client.geocode_batch(queries), expected)
+        self.assertEqual(sorted(self.single_calls), sorted(queries))
+        self.client._geocode_cache.clear()
+        self.batch_status = 200
+        self.assertEqual(self.client.geocode_batch(queries), expected)
+        self.assertEqual(len(self.batch_calls), 2)
+        self.assertEqual(len(self.single_calls), len(queries))
+
+    def test_short_batch_reply_looks_up_the_tail(self):
+        self.batch_size = 1
+        queries = list(self.PLACES)
+        found = self.client.geocode_batch(queries, states=["TX", "OK", "KS"])
+        self.assertEqual(found, [place[:2] for place in self.PLACES.values()])
+        self.assertEqual(sorted(self.single_calls), sorted(queries[1:]))
+
+    def test_blank_state_matches_nothing(self):
+        queries = list(self.PLACES)
+        self.assertEqual(self.client.geocode_batch(queries, states=["", "", ""]), [None, None, None])
+        self.batch_status = 429
+        self.client._geocode_cache.clear()
+        self.assertEqual(self.client.geocode_batch(queries, states=["", "", ""]), [None, None, None])
+        self.assertEqual(sorted(self.single_calls), sorted(queries))
+
+
+class MapboxCacheTests(SimpleTestCase):
+    ROUTE = {
+        "geometry": {"type": "LineString", "coordinates": [[-97.74, 30.27], [-95.99, 36.15]]},
+        "distance": 700000.0,
+        "duration": 25000.0,
+        "weight": 25100.0,
+        "legs": [{"steps": [{"name": "I-35"}], "summary": "I-35"}],
+    }
+
+    def setUp(self):
+        for name in ("_geocode_cache", "_reverse_cache"):
+            patcher = mock.patch.object(MapboxClient, name, TTLCache(100, 60))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = MapboxClient("test-token")
+        self.client._session = mock.Mock()
+        self.client._session.get.side_effect = self._respond
+        self.urls = []
+
+    def _respond(self, url, params, timeout):
+        self.urls.append(url)
+        if "/directions/" in url:
+            data = {"routes": [self.ROUTE], "waypoints": [{"name": "start"}, {"name": "end"}]}
+        else:
+            data = {"features": [{**_feature(30.27, -97.74, "TX"), "text": "Austin"}]}
+        return mock.Mock(status_code=200, content=orjson.dumps(data), text="")
+
+    @override_settings(CACHES={
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "mapbox": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "mapbox-tests"},
+    })
+    def test_directions_are_trimmed_and_cached(self):
+        caches["mapbox"].clear()
+        route = self.client.directions((30.27, -97.74), (36.15, -95.99))
+        self.assertEqual(route, {key: self.ROUTE[key] for key in ("geometry", "distance", "duration")})
+        self.assertEqual(self.client.directions((30.27, -97.74), (36.15, -95.99)), route)
+        self.assertEqual(len(self.urls), 1)
+        with_steps = self.client.directions((30.27, -97.74), (36.15, -95.99), include_steps=True)
+        self.assertEqual(with_steps["legs"], self.ROUTE["legs"])
+        self.assertNotIn("weight", with_steps)
+        self.assertEqual(len(self.urls), 2)
+
+    def test_reverse_geocode_shares_an_entry_within_rounding(self):
+        first = self.client.reverse_geocode(30.2671, -97.7432)
+        second = self.client.reverse_geocode(30.2674, -97.7428)
+        self.assertEqual(first, {"city": "Austin", "state": "TX"})
+        self.assertEqual(second, first)
+        self.assertEqual(len(self.urls), 1)
+        self.assertEqual(len(self.client._reverse_cache), 1)
+        self.client.reverse_geocode(30.2681, -97.7432)  # next 3-decimal cell
+        self.assertEqual(len(self.urls), 2)
+
+
+class LoadFuelStationsTests(SimpleTestCase):
+    CSV = (
+        "OPIS Truckstop ID,Truckstop Name,Address,City,State,Rack ID,Retail Price\n"
+        '7,WOODSHED OF BIG CABIN,"I-44, EXIT 283 & US-69",Big Cabin,OK,307,3.50\n'
+        '7,WOODSHED OF BIG CABIN,"I-44, EXIT 283 & US-69",Big Cabin,OK,308,3.25\n'
+        '7, WOODSHED ,"I-44, EXIT 283 & US-69 ", Big Cabin ,OK,309,3.40\n'
+        "9,KWIK TRIP #796,I-94 EXIT 143,Tomah,WI,420,3.10\n"
+        "9,KWIK TRIP #796,I-94 EXIT 143,Tomah,WI,421,3.10\n"
+        "11,EMPTY PRICE,1 Main St,Austin,TX,1,\n"
+        "12,BAD PRICE,2 Main St,Austin,TX,1,N/A\n"
+        "13,SHORT ROW,3 Main St,Austin\n"
+        "14,OTHER CITY,I-94 EXIT 143,Sparta,WI,422,3.60\n"
+    )
+
+    def _load(self, text):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = Path(tmp.name) / "prices.csv"
+        path.write_text(text)
+        return load_fuel_stations(str(path))
+
+    def test_keeps_cheapest_row_per_station(self):
+        stations = self._load(self.CSV)
+        self.assertEqual(
+            [(s.opis_id, s.address, s.city, s.state, s.rack_id, s.retail_price) for s in stations],
+            [
+                ("7", "I-44, EXIT 283 & US-69", "Big Cabin", "OK", "308", 3.25),
+                ("9", "I-94 EXIT 143", "Tomah", "WI", "420", 3.10),  # ties keep the first row
+                ("14", "I-94 EXIT 143", "Sparta", "WI", "422", 3.60),
+            ],
+        )
+        self.assertEqual(stations[0].name, "WOODSHED OF BIG CABIN")
+
+    def test_all_valid_prices_take_the_fast_path(self):
+        rows = [line for line in self.CSV.splitlines() if "PRICE" not in line and "SHORT" not in line]
+        self.assertEqual(len(self._load("\n".join(rows) + "\n")), 3)
+
+    def test_missing_column_is_reported(self):
+        with self.assertRaisesMessage(ValueError, "Retail Price"):
+            self._load("OPIS Truckstop ID,Truckstop Name,Address,City,State,Rack ID\n")
+
+
+def _catalog(count, located_fraction, seed):
+    rng = random.Random(seed)
+    stations = [
+        FuelStation(
+            opis_id=str(idx),
+            name=f"Station {idx}",
+            address=f"{idx} Main St",
+            city=f"City {idx % 40}",
+            state=("TX", "OK", "KS", "NM")[idx % 4],
+            rack_id="1",
+            retail_price=round(rng.uniform(3.0, 4.5), 3),
+        )
+        for idx in range(count)
+    ]
+    catalog = FuelCatalog(stations)
+    for idx in range(count):
+        if rng.random() < located_fraction:
+            catalog.record_coords(idx, (rng.uniform(25.0, 49.0), rng.uniform(-124.0, -67.0)))
+    return catalog
+
+
+class GridIndexTests(SimpleTestCase):
+    def test_query_radius_returns_every_point_in_range(self):
+        rng = random.Random(5)
+        points = [(rng.uniform(25.0, 49.0), rng.uniform(-124.0, -67.0)) for _ in range(2000)]
+        grid = GridIndex()
+        for idx, (lat, lon) in enumerate(points):
+            grid.add(idx, lat, lon)
+        self.assertEqual(len(grid), len(points))
+        for _ in range(100):
+            target = (rng.uniform(25.0, 49.0), rng.uniform(-124.0, -67.0))
+            radius = rng.choice([5.0, 50.0, 300.0, 3000.0])
+            found = set(grid.query_radius(target[0], target[1], radius).tolist())
+            expected = {idx for idx, point in enumerate(points) if haversine_miles(point, target) <= radius}
+            self.assertLessEqual(expected, found)
+
+    def test_query_boxes_returns_every_point_in_the_boxes(self):
+        rng = random.Random(6)
+        points = [(rng.uniform(25.0, 49.0), rng.uniform(-124.0, -67.0)) for _ in range(2000)]
+        grid = GridIndex()
+        for idx, (lat, lon) in enumerate(points):
+            grid.add(idx, lat, lon)
+        for count in (1, 5, 200):
+            lo_lats = np.array([rng.uniform(25.0, 45.0) for _ in range(count)])
+            lo_lons = np.array([rng.uniform(-124.0, -75.0) for _ in range(count)])
+            hi_lats = lo_lats + rng.uniform(0.1, 4.0)
+            hi_lons = lo_lons + rng.uniform(0.1, 8.0)
+            found = grid.query_boxes(lo_lats, lo_lons, hi_lats, hi_lons)
+            self.assertTrue(np.all(np.diff(found) >= 0))
+            expected = {
+                idx
+                for idx, (lat, lon) in enumerate(points)
+                if np.any((lo_lats <= lat) & (lat <= hi_lats) & (lo_lons <= lon) & (lon <= hi_lons))
+            }
+            self.assertLessEqual(expected, set(found.tolist()))
+
+
+class StationLocatorSearchTests(SimpleTestCase):
+    def test_nearest_to_point_matches_brute_force(self):
+        catalog = _catalog(3000, 0.3, seed=1)
+        locator = StationLocator(catalog, mapbox_client=None)
+        located = [station for station in catalog.stations if station.coordinates]
+        rng = random.Random(2)
+        for _ in range(100):
+            target = (rng.uniform(20.0, 55.0), rng.uniform(-130.0, -60.0))
+            expected = min(haversine_miles(station.coordinates, target) for station in located)
+            found = locator.nearest_to_point(target)
+            self.assertAlmostEqual(haversine_miles(found.coordinates, target), expected, places=6)
+
+    def test_nearest_on_route_matches_brute_force(self):
+        rng = random.Random(4)
+        for sparse in (False, True):
+            catalog = _catalog(3000, 0.01 if sparse else 0.4, seed=3)
+            locator = StationLocator(catalog, mapbox_client=None)
+            located = [station for station in catalog.stations if station.coordinates]
+            for _ in range(15):
+                lon, lat = rng.uniform(-120.0, -75.0), rng.uniform(28.0, 46.0)
+                route = []
+                for _ in range(rng.randint(2, 200)):
+                    lon += rng.uniform(-0.3, 0.3)
+                    lat += rng.uniform(-0.2, 0.2)
+                    route.append([lon, lat])
+                segments = polyline_segments(route)
+                expected = min(
+                    nearest_point_distance_miles(station.coordinates, segments) for station in located
+                )
+                found = locator.nearest_on_route_prepared(segments)
+                self.assertAlmostEqual(
+                    nearest_point_distance_miles(found.coordinates, segments), expected, places=6
+                )
+                self.assertIsNone(locator.nearest_on_route_prepared(segments, max_distance_miles=expected - 1e-3))
+
+    def test_locators_see_stations_located_by_another_request(self):
+        catalog = _catalog(500, 0.5, seed=7)
+        first = StationLocator(catalog, mapbox_client=None)
+        second = StationLocator(catalog, mapbox_client=None)
+        idx = next(idx for idx, station in enumerate(catalog.stations) if not station.coordinates)
+        target = (60.0, -150.0)  # far from every other station
+        second._record_coords(catalog.stations[idx], target)
+        self.assertIs(first.nearest_to_point(target), catalog.stations[idx])
+        self.assertEqual(first.cheapest_for_markers([target], 10.0)[0], idx)
+
+    def test_concurrent_first_requests_share_one_catalog(self):
+        built = []
+
+        def slow_load():
+            time.sleep(0.05)
+            built.append(_catalog(10, 1.0, seed=1))
+            return built[-1]
+
+        with mock.patch.object(fuel_data, "_catalog", None), \
+                mock.patch.object(fuel_data, "load_fuel_catalog", slow_load):
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                catalogs = list(pool.map(lambda _: fuel_data.get_fuel_catalog(), range(8)))
+        self.assertEqual(len(built), 1)
+        self.assertTrue(all(catalog is built[0] for catalog in catalogs))
+
+
+class _RecordingMapbox:
+    """Answers geocoding queries from a fixed table and records every station looked up."""
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.address_queries = []
+
+    def _lookup(self, query):
+        if query.split(",")[0].endswith("Main St"):
+            self.address_queries.append(query)
+        return self.answers.get(query)
+
+    def geocode(self, query):
+        return self._lookup(query)
+
+    def geocode_with_state(self, query, state):
+        return self._lookup(query)
+
+    def geocode_batch(self, queries, states=None):
+        return [self._lookup(query) for query in queries]
+
+
+class _SequentialLocator(StationLocator):
+    """Reference scan: geocode one station at a time, stopping at the first in range."""
+
+    def _scan_in_waves(self, stations, target, radius_miles, budget):
+        used = 0
+        for station in stations:
+            coords, attempted = self._ensure_coords(station, allow_geocode=used < budget)
+            used += attempted
+            if coords and haversine_miles(coords, target) <= radius_miles:
+                return station, used
+        return None, used
+
+
+def _geocode_answers(catalog, seed):
+    rng = random.Random(seed)
+    answers = {}
+    for station in catalog.stations:
+        if station.coordinates:
+            continue
+        point = (rng.uniform(25.0, 49.0), rng.uniform(-124.0, -67.0))
+        queries = StationLocator._geocode_queries(station)
+        if rng.random() < 0.6:
+            answers[queries[0][0]] = point
+        elif rng.random() < 0.5:
+            answers[queries[1][0]] = point
+    return answers
+
+
+class CheapestNearbyTests(SimpleTestCase):
+    def _locators(self, seed):
+        answers = _geocode_answers(_catalog(400, 0.2, seed), seed)
+        waves = StationLocator(_catalog(400, 0.2, seed), _RecordingMapbox(answers))
+        sequential = _SequentialLocator(_catalog(400, 0.2, seed), _RecordingMapbox(answers))
+        return waves, sequential
+
+    def test_same_winner_and_budget_use_as_sequential_scan(self):
+        rng = random.Random(11)
+        for seed in range(30):
+            waves, sequential = self._locators(seed)
+            target = (rng.uniform(28.0, 46.0), rng.uniform(-120.0, -72.0))
+            radius = rng.choice([60.0, 150.0, 400.0])
+            budget = rng.choice([0, 1, 3, 20, 80])
+            state = rng.choice([None, "TX", "OK"])
+            results = []
+            for locator in (waves, sequential):
+                pool = locator.stations_for_state(state) if state else None
+                found = locator.cheapest_nearby(target, radius, True, budget, candidates=pool)
+                results.append((found and found.opis_id, locator.mapbox.address_queries))
+            (wave_winner, wave_calls), (seq_winner, seq_calls) = results
+            self.assertEqual(wave_winner, seq_winner)
+            self.assertEqual(len(wave_calls), len(set(wave_calls)))
+            self.assertLessEqual(len(wave_calls), budget)
+            self.assertEqual(wave_calls[: len(seq_calls)], seq_calls)
+            if wave_winner is None:
+                self.assertEqual(wave_calls, seq_calls)
+            else:
+                self.assertLess(len(wave_calls) - len(seq_calls), StationLocator.GEOCODE_WORKERS)
+
+    def test_first_within_returns_first_in_range_of_wave(self):
+        waves, _ = self._locators(seed=5)
+        unlocated = [station for station in waves.stations if not station.coordinates][:6]
+        located = [station for station in waves.stations if station.coordinates][:2]
+        wave = [unlocated[0], located[0], *unlocated[1:], located[1]]
+        target, radius = (37.0, -96.0), 900.0
+        expected = None
+        for station in wave:
+            queries = [query for query, _ in StationLocator._geocode_queries(station)]
+            coords = station.coordinates or next(
+                (waves.mapbox.answers[query] for query in queries if query in waves.mapbox.answers), None
+            )
+            if coords and haversine_miles(coords, target) <= radius:
+                expected = station
+                break
+        found = waves._first_within(wave, unlocated, target, radius)
+        self.assertIs(found, expected)
+        self.assertEqual(len(waves.mapbox.address_queries), len(unlocated))
+
+    def test_cheapest_for_markers_respects_candidate_pools(self):
+        catalog = _catalog(2000, 0.4, seed=9)
+        locator = StationLocator(catalog, mapbox_client=None)
+        rng = random.Random(10)
+        markers = np.array([(rng.uniform(28.0, 46.0), rng.uniform(-120.0, -72.0)) for _ in range(40)])
+        pools = [rng.choice([None, *catalog.state_index.values()]) for _ in markers]
+        radius = 120.0
+        best = locator.cheapest_for_markers(markers, radius, pools)
+        np.testing.assert_array_equal(locator.cheapest_for_markers(markers, radius, pools, chunk_size=7), best)
+        for marker, pool, found in zip(markers, pools, best):
+            pool = catalog.stations if pool is None else pool
+            hits = [
+                catalog.position(station)
+                for station in pool
+                if station.coordinates and haversine_miles(station.coordinates, tuple(marker)) <= radius
+            ]
+            expected = min(hits, key=lambda idx: catalog.price_rank[idx]) if hits else -1
+            self.assertEqual(found, expected)
+
+
+class StationCacheTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = Path(tmp.name) / "coords.jsonl"
+
+    def _open(self):
+        cache = StationCache(str(self.path))
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_replay_is_last_write_wins(self):
+        cache = self._open()
+        cache.set("a", (1.0, 2.0))
+        cache.set("b", (3.0, 4.0))
+        cache.set("a", (5.0, 6.0))
+        reloaded = self._open()
+        self.assertEqual(reloaded.get("a"), (5.0, 6.0))
+        self.assertEqual(reloaded.get("b"), (3.0, 4.0))
+        self.assertEqual(reloaded.get_many(["a", "missing"]), {"a": (5.0, 6.0)})
+
+    def test_torn_tail_is_dropped_and_appends_stay_readable(self):
+        self._open().set("a", (1.0, 2.0))
+        with open(self.path, "ab") as fp:
+            fp.write(b'{"b":[3.0')  # interrupted append
+        cache = self._open()
+        self.assertEqual(len(cache), 1)
+        cache.set("c", (5.0, 6.0))
+        reloaded = self._open()
+        self.assertEqual(reloaded.get("a"), (1.0, 2.0))
+        self.assertEqual(reloaded.get("c"), (5.0, 6.0))
+        self.assertIsNone(reloaded.get("b"))
+
+    def test_malformed_entries_are_skipped_and_compacted(self):
+        self._open().set("a", (1.0, 2.0))
+        with open(self.path, "ab") as fp:
+            fp.write(b'[]\n1\n{"k": null}\n{"k": [1]}\n{"k": ["x", 2]}\n{"k": [true, {}]}\n')
+        cache = self._open()
+        self.assertEqual(cache.get_many(["a", "k"]), {"a": (1.0, 2.0)})
+        self.assertEqual(self.path.read_bytes().count(b"\n"), 1)
+
+    def test_load_compacts_superseded_lines(self):
+        cache = self._open()
+        for idx in range(10):
+            cache.set("a", (float(idx), 0.0))
+        self._open()
+        self.assertEqual(self.path.read_bytes().count(b"\n"), 1)
+
+    def test_append_after_another_instance_compacts(self):
+        writer = self._open()
+        for idx in range(10):
+            writer.set("k1", (float(idx), 0.0))
+        self._open()  # compacts: the log is replaced by a new file
+        writer.set("k2", (1.0, 2.0))
+        reloaded = self._open()
+        self.assertEqual(reloaded.get("k1"), (9.0, 0.0))
+        self.assertEqual(reloaded.get("k2"), (1.0, 2.0))
+
+    def test_unwritable_path_keeps_coordinates_in_memory(self):
+        cache = StationCache("/dev/null/coords.jsonl")  # parent is not a directory
+        self.addCleanup(cache.close)
+        with self.assertLogs("api.station_cache", level="WARNING"):
+            cache.set("a", (1.0, 2.0))
+        cache.set("b", (3.0, 4.0))
+        cache.compact()
+        self.assertEqual(cache.get_many(["a", "b"]), {"a": (1.0, 2.0), "b": (3.0, 4.0)})
+
+    def test_without_a_path_nothing_is_written(self):
+        with override_settings(STATION_CACHE_PATH=None):
+            cache = StationCache()
+        self.addCleanup(cache.close)
+        cache.set("a", (1.0, 2.0))
+        cache.compact()
+        self.assertIsNone(cache.path)
+        self.assertEqual(cache.get("a"), (1.0, 2.0))
+
+    def test_compaction_keeps_other_instances_appends(self):
+        first = self._open()
+        second = self._open()
+        second.set("b", (3.0, 4.0))
+        first.set("a", (1.0, 2.0))
+        first.compact()
+        reloaded = self._open()
+        self.assertEqual(reloaded.get("a"), (1.0, 2.0))
+        self.assertEqual(reloaded.get("b"), (3.0, 4.0))
+
+
+class TTLCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("api.ttl_cache.time.monotonic", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_entries_expire_after_ttl(self):
+        cache = TTLCache(maxsize=10, ttl=60)
+        cache.set("a", 1)
+        self.now += 59
+        self.assertEqual(cache.get("a"), 1)
+        self.now += 1
+        self.assertIsNone(cache.get("a"))
+        self.assertNotIn("a", cache)
+        self.assertEqual(len(cache), 0)
+
+    def test_set_refreshes_ttl(self):
+        cache = TTLCache(maxsize=10, ttl=60)
+        cache.set("a", 1)
+        self.now += 50
+        cache.set("a", 2)
+        self.now += 50
+        self.assertEqual(cache.get("a"), 2)
+
+    def test_evicts_least_recently_used(self):
+        cache = TTLCache(maxsize=3, ttl=60)
+        for key in "abc":
+            cache.set(key, key)
+        cache.get("a")  # "b" is now the least recently used
+        cache.set("d", "d")
+        self.assertEqual(len(cache), 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual([cache.get(key) for key in "acd"], ["a", "c", "d"])
+
+    def test_default_and_clear(self):
+        cache = TTLCache(maxsize=3, ttl=60)
+        self.assertEqual(cache.get("missing", "fallback"), "fallback")
+        cache.set("a", 1)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+def _stride_downsample(points, max_points):
+    """The fixed-stride sampler downsample_polyline replaced."""
+    reduced = points[:: max(1, len(points) // max_points)]
+    return reduced if reduced[-1] == points[-1] else [*reduced, points[-1]]
+
+
+def _max_deviation_miles(points, simplified):
+    arr = np.asarray(points)
+    return float(nearest_point_distances_miles(arr[:, 1], arr[:, 0], polyline_segments(simplified)).max())
+
+
+class DownsamplePolylineTests(SimpleTestCase):
+    def _bent_route(self, count=5000):
+        # A wandering [lon, lat] route across the US with sharp turns and small wiggles.
+        rng = random.Random(5)
+        lon, lat, heading = -118.0, 34.0, 0.3
+        points = []
+        for idx in range(count):
+            if idx % 600 == 0:
+                heading += rng.uniform(-1.5, 1.5)
+            heading += rng.uniform(-0.05, 0.05)
+            lon += 0.012 * math.cos(heading)
+            lat += 0.008 * math.sin(heading)
+            points.append([lon, lat])
+        return points
+
+    def test_keeps_endpoints_within_budget(self):
+        points = self._bent_route()
+        for max_points in (2, 3, 50, 400):
+            reduced = downsample_polyline(points, max_points=max_points)
+            self.assertLessEqual(len(reduced), max_points)
+            self.assertEqual(reduced[0].tolist(), points[0])
+            self.assertEqual(reduced[-1].tolist(), points[-1])
+
+    def test_short_polyline_is_returned_as_is(self):
+        points = self._bent_route(100)
+        np.testing.assert_array_equal(downsample_polyline(points, max_points=400), points)
+
+    def test_straight_line_collapses_to_endpoints(self):
+        points = [[-100.0 + 0.01 * idx, 35.0 + 0.005 * idx] for idx in range(1000)]
+        reduced = downsample_polyline(points, max_points=400)
+        self.assertEqual(reduced.tolist(), [points[0], points[-1]])
+
+    def test_deviation_no_worse_than_stride(self):
+        points = self._bent_route()
+        for max_points in (50, 400):
+            self.assertLessEqual(
+                _max_deviation_miles(points, downsample_polyline(points, max_points=max_points)),
+                _max_deviation_miles(points, _stride_downsample(points, max_points)),
+            )
+
+
+class BuildMileMarkersTests(SimpleTestCase):
+    def test_multiples_of_range_then_destination(self):
+        self.assertEqual(build_mile_markers(1000, 300), [0.0, 300.0, 600.0, 900.0, 1000])
+        self.assertEqual(build_mile_markers(900, 300), [0.0, 300.0, 600.0, 900])
+
+    def test_no_drift_marker_before_destination(self):
+        markers = build_mile_markers(3500, 0.1)
+        self.assertEqual(len(markers), 35001)
+        self.assertEqual(markers[-3:], [3499.8, 3499.9, 3500])
+
+    def test_range_at_least_distance_fuels_once_at_start(self):
+        self.assertEqual(build_mile_markers(1000, 1000), [0.0, 1000])
+        self.assertEqual(build_mile_markers(1000, float("inf")), [0.0, 1000])
+
+    def test_empty_route_and_invalid_range(self):
+        self.assertEqual(build_mile_markers(0, 300), [0.0])
+        with self.assertRaises(ValueError):
+            build_mile_markers(1000, 0)
+
+
+class RoutePlanningViewTests(SimpleTestCase):
+    def test_rejects_non_positive_range_and_mpg(self):
+        cases = (("range_miles", 0), ("range_miles", -100), ("range_miles", "inf"), ("mpg", 0), ("mpg", "nan"))
+        for field, value in cases:
+            payload = {"start": "30.27,-97.74", "end": "36.15,-95.99", field: value}
+            response = self.client.post("/api/route/", orjson.dumps(payload), content_type="application/json")
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(orjson.loads(response.content), {"error": "'range_miles' and 'mpg' must be positive and finite."})
+
+    def test_rejects_negative_or_non_finite_radius(self):
+        for value in (-1, "nan", "inf"):
+            payload = {"start": "30.27,-97.74", "end": "36.15,-95.99", "station_radius_miles": value}
+            response = self.client.post("/api/route/", orjson.dumps(payload), content_type="application/json")
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(
+                orjson.loads(response.content),
+                {"error": "'station_radius_miles' must be non-negative and finite."},
+            )
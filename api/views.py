@@ -1,26 +1,29 @@
-import json
-from typing import Any, Dict, Tuple
+from typing import Any, Dict, Optional, Tuple
 
 from django.conf import settings
-from django.http import JsonResponse
+from django.http import HttpResponse
 from django.utils.decorators import method_decorator
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 
-from .fuel_data import load_fuel_stations, index_by_city_state, index_by_state
+from .fuel_data import FuelCatalog, get_fuel_catalog
 from .fuel_optimizer import FuelPlanner
 from .mapbox_client import MapboxClient, MapboxClientError
+from .station_cache import get_station_cache
 from .station_locator import StationLocator
 import math
 
+import numpy as np
+import orjson
 
-def _filter_stations_by_bbox(stations, coordinates, margin_miles: float = 100.0):
+
+def _route_bbox_mask(catalog: FuelCatalog, coordinates, margin_miles: float = 100.0) -> Optional[np.ndarray]:
+    """Mask of catalog stations inside the route's bounding box grown by `margin_miles`."""
     if not coordinates:
-        return stations
-    lats = [lat for _, lat in coordinates]
-    lons = [lon for lon, _ in coordinates]
-    min_lat, max_lat = min(lats), max(lats)
-    min_lon, max_lon = min(lons), max(lons)
+        return None
+    route = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+    min_lon, min_lat = route.min(axis=0)
+    max_lon, max_lat = route.max(axis=0)
     mid_lat = (min_lat + max_lat) / 2
     lat_margin = margin_miles / 69.0
     lon_margin = margin_miles / (69.0 * max(math.cos(math.radians(mid_lat)), 0.1))
@@ -28,14 +31,19 @@ def _filter_stations_by_bbox(stations, coordinates, margin_miles: float = 100.0)
     hi_lat = max_lat + lat_margin
     lo_lon = min_lon - lon_margin
     hi_lon = max_lon + lon_margin
-    return [
-        s
-        for s in stations
-        if s.coordinates
-        and lo_lat <= s.coordinates[0] <= hi_lat
-        and lo_lon <= s.coordinates[1] <= hi_lon
-        or not s.coordinates  # keep if unknown; may geocode into range
-    ]
+    lats, lons = catalog.lats, catalog.lons
+    # NaN marks unknown coordinates: keep those, they may geocode into range.
+    in_box = (lats >= lo_lat) & (lats <= hi_lat) & (lons >= lo_lon) & (lons <= hi_lon)
+    return np.isnan(lats) | in_box
+
+
+def _json_response(data: Dict[str, Any], status: int = 200) -> HttpResponse:
+    # orjson serializes the large route geometry several times faster than JsonResponse.
+    return HttpResponse(
+        orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY),
+        content_type="application/json",
+        status=status,
+    )
 
 
 def _parse_location(value: Any, mapbox: MapboxClient) -> Tuple[float, float]:
@@ -70,9 +78,9 @@ def _parse_location(value: Any, mapbox: MapboxClient) -> Tuple[float, float]:
 class RoutePlanningView(View):
     def post(self, request):
         try:
-            payload = json.loads(request.body.decode() or "{}")
-        except json.JSONDecodeError:
-            return JsonResponse({"error": "Invalid JSON body."}, status=400)
+            payload = orjson.loads(request.body or b"{}")
+        except orjson.JSONDecodeError:
+            return _json_response({"error": "Invalid JSON body."}, status=400)
 
         start_raw = payload.get("start")
         end_raw = payload.get("end")
@@ -82,33 +90,34 @@ class RoutePlanningView(View):
         geocode_budget = int(payload.get("geocode_budget_per_stop", 50))
 
         if not start_raw or not end_raw:
-            return JsonResponse({"error": "Both 'start' and 'end' are required."}, status=400)
+            return _json_response({"error": "Both 'start' and 'end' are required."}, status=400)
+        if not (0 < vehicle_range < math.inf and 0 < mpg < math.inf):
+            return _json_response({"error": "'range_miles' and 'mpg' must be positive and finite."}, status=400)
+        if not 0 <= radius < math.inf:
+            return _json_response(
+                {"error": "'station_radius_miles' must be non-negative and finite."}, status=400
+            )
 
         try:
             mapbox = MapboxClient()
             start = _parse_location(start_raw, mapbox)
             end = _parse_location(end_raw, mapbox)
         except (ValueError, MapboxClientError) as exc:
-            return JsonResponse({"error": str(exc)}, status=400)
+            return _json_response({"error": str(exc)}, status=400)
 
         try:
             route = mapbox.directions(start, end)
         except MapboxClientError as exc:
-            return JsonResponse({"error": str(exc)}, status=502)
+            return _json_response({"error": str(exc)}, status=502)
 
         geometry = route["geometry"]
         route_distance_miles = route["distance"] / 1609.344
-        stations = load_fuel_stations()
-        stations = _filter_stations_by_bbox(
-            stations, geometry.get("coordinates", []), margin_miles=radius + 100
-        )
-        station_index = index_by_city_state(stations)
-        state_index = index_by_state(stations)
+        catalog = get_fuel_catalog()
         locator = StationLocator(
-            stations,
+            catalog,
             mapbox,
-            city_state_index=station_index,
-            state_index=state_index,
+            station_cache=get_station_cache(),
+            keep=_route_bbox_mask(catalog, geometry.get("coordinates", []), margin_miles=radius + 100),
         )
         planner = FuelPlanner(
             locator=locator,
@@ -151,4 +160,4 @@ class RoutePlanningView(View):
                 "station_radius_miles": radius,
             },
         }
-        return JsonResponse(response, status=200)
+        return _json_response(response, status=200)
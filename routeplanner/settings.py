@@ -124,10 +124,28 @@ STATIC_URL = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Logging: the planner's per-marker trace is emitted at DEBUG on the "api" logger;
+# set API_LOG_LEVEL=DEBUG to see it.
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {
+        "console": {"class": "logging.StreamHandler"},
+    },
+    "loggers": {
+        "api": {
+            "handlers": ["console"],
+            "level": os.getenv("API_LOG_LEVEL", "WARNING"),
+        },
+    },
+}
+
 # Mapbox / fuel dataset configuration
 MAPBOX_ACCESS_TOKEN = os.getenv("MAPBOX_ACCESS_TOKEN") or os.getenv("MAPBOX_TOKEN", "")
 FUEL_DATA_PATH = os.getenv(
     "FUEL_DATA_PATH", str(BASE_DIR / "fuel-prices-for-be-assessment.csv")
 )
+# Unset: geocoded station coordinates are kept in memory only (see README on Mapbox terms).
+STATION_CACHE_PATH = os.getenv("STATION_CACHE_PATH") or None
 DEFAULT_RANGE_MILES = float(os.getenv("DEFAULT_RANGE_MILES", "500"))
 DEFAULT_MPG = float(os.getenv("DEFAULT_MPG", "10"))